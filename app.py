@@ -6,6 +6,10 @@ import os
 from celery_app import make_celery
 from extensions import db
 from routes import bp
+from models import bcrypt
+from bulk_import import import_locations_command
+from migrate import migrate_command
+import metrics
 
 load_dotenv()
 
@@ -24,6 +28,61 @@ app.config['CLOUDINARY_CLOUD_NAME'] = os.getenv('CLOUDINARY_CLOUD_NAME')
 app.config['CLOUDINARY_API_KEY'] = os.getenv('CLOUDINARY_API_KEY')
 app.config['CLOUDINARY_API_SECRET'] = os.getenv('CLOUDINARY_API_SECRET')
 app.config['REPLICATE_API_TOKEN'] = os.getenv('REPLICATE_API_TOKEN')
+app.config['REPLICATE_WEBHOOK_URL'] = os.getenv('REPLICATE_WEBHOOK_URL')
+app.config['REPLICATE_WEBHOOK_SECRET'] = os.getenv('REPLICATE_WEBHOOK_SECRET')
+app.config['RATE_LIMITS'] = {
+    # provider: (calls per second, burst)
+    'replicate': (float(os.getenv('REPLICATE_RATE_PER_SECOND', 5)), int(os.getenv('REPLICATE_RATE_BURST', 10))),
+    'cloudinary': (float(os.getenv('CLOUDINARY_RATE_PER_SECOND', 10)), int(os.getenv('CLOUDINARY_RATE_BURST', 20))),
+}
+app.config['GENERATION_QUEUE'] = os.getenv('GENERATION_QUEUE', 'celery')
+app.config['CLOUDINARY_UPLOAD_CHUNK_SIZE'] = int(os.getenv('CLOUDINARY_UPLOAD_CHUNK_SIZE', 6 * 1024 * 1024))
+app.config['IMAGE_DOWNLOAD_TIMEOUT'] = (
+    float(os.getenv('IMAGE_DOWNLOAD_CONNECT_TIMEOUT', 5)),
+    float(os.getenv('IMAGE_DOWNLOAD_READ_TIMEOUT', 30))
+)
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.getenv('BCRYPT_LOG_ROUNDS', 12))
+app.config['HASHING_WORKERS'] = int(os.getenv('HASHING_WORKERS', 2))
+app.config['HASHING_QUEUE'] = int(os.getenv('HASHING_QUEUE', 8))
+app.config['HASHING_QUEUE_TIMEOUT'] = float(os.getenv('HASHING_QUEUE_TIMEOUT', 0.5))
+app.config['IDENTITY_CACHE_TTL'] = int(os.getenv('IDENTITY_CACHE_TTL', 10))
+app.config['IDENTITY_CACHE_REDIS_TTL'] = int(os.getenv('IDENTITY_CACHE_REDIS_TTL', 300))
+app.config['IDENTITY_CACHE_MAX_ENTRIES'] = int(os.getenv('IDENTITY_CACHE_MAX_ENTRIES', 10000))
+app.config['BATCH_CONTEXT_MAX_POINTS'] = int(os.getenv('BATCH_CONTEXT_MAX_POINTS', 100))
+app.config['BATCH_CONTEXT_MAX_RADIUS'] = float(os.getenv('BATCH_CONTEXT_MAX_RADIUS', 5000))
+app.config['NEAREST_MAX_K'] = int(os.getenv('NEAREST_MAX_K', 100))
+app.config['PING_INGESTION_ENABLED'] = os.getenv('PING_INGESTION_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+app.config['PING_MIN_DISTANCE'] = float(os.getenv('PING_MIN_DISTANCE', 50))
+app.config['PING_RADIUS'] = float(os.getenv('PING_RADIUS', 500))
+app.config['PING_LAST_POSITION_TTL'] = int(os.getenv('PING_LAST_POSITION_TTL', 3600))
+app.config['PING_STREAM_MAXLEN'] = int(os.getenv('PING_STREAM_MAXLEN', 1000000))
+app.config['PING_DRAIN_SECONDS'] = float(os.getenv('PING_DRAIN_SECONDS', 5))
+app.config['PING_DRAIN_BATCH_SIZE'] = int(os.getenv('PING_DRAIN_BATCH_SIZE', 1000))
+app.config['PING_DRAIN_MAX_BATCHES'] = int(os.getenv('PING_DRAIN_MAX_BATCHES', 20))
+app.config['CORRIDOR_MAX_VERTICES'] = int(os.getenv('CORRIDOR_MAX_VERTICES', 5000))
+app.config['CORRIDOR_MAX_DISTANCE'] = float(os.getenv('CORRIDOR_MAX_DISTANCE', 2000))
+app.config['CORRIDOR_SECTION_VERTICES'] = int(os.getenv('CORRIDOR_SECTION_VERTICES', 25))
+app.config['SPATIAL_INDEX_ENABLED'] = os.getenv('SPATIAL_INDEX_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+app.config['SPATIAL_INDEX_CELL_DEGREES'] = float(os.getenv('SPATIAL_INDEX_CELL_DEGREES', 0.01))
+app.config['SPATIAL_INDEX_CHECK_SECONDS'] = float(os.getenv('SPATIAL_INDEX_CHECK_SECONDS', 5))
+app.config['SPATIAL_INDEX_REBUILD_SECONDS'] = float(os.getenv('SPATIAL_INDEX_REBUILD_SECONDS', 600))
+app.config['IMPORT_BATCH_SIZE'] = int(os.getenv('IMPORT_BATCH_SIZE', 1000))
+app.config['IMPORT_ENQUEUE_CHUNK'] = int(os.getenv('IMPORT_ENQUEUE_CHUNK', 500))
+app.config['REDIS_URL'] = os.getenv('REDIS_URL', os.getenv('CELERY_BROKER_URL'))
+app.config['IMAGE_GENERATION_LEASE_TTL'] = int(os.getenv('IMAGE_GENERATION_LEASE_TTL', 900))
+app.config['IMAGE_FAILURE_COOLDOWN'] = int(os.getenv('IMAGE_FAILURE_COOLDOWN', 3600))
+app.config['CONTEXT_CACHE_TTL'] = int(os.getenv('CONTEXT_CACHE_TTL', 300))
+app.config['CONTEXT_CACHE_CELL_DEGREES'] = float(os.getenv('CONTEXT_CACHE_CELL_DEGREES', 0.005))
+app.config['CONTEXT_CACHE_RADIUS_BUCKETS'] = [
+    int(r) for r in os.getenv('CONTEXT_CACHE_RADIUS_BUCKETS', '250,500,1000,2000,5000').split(',')
+]
+app.config['TILE_CACHE_TTL'] = int(os.getenv('TILE_CACHE_TTL', 86400))
+app.config['TILE_MAX_ZOOM'] = int(os.getenv('TILE_MAX_ZOOM', 20))
+app.config['TILE_EXTENT'] = int(os.getenv('TILE_EXTENT', 4096))
+app.config['TILE_BUFFER'] = int(os.getenv('TILE_BUFFER', 64))
+app.config['VIEWPORT_CLUSTER_MAX_ZOOM'] = int(os.getenv('VIEWPORT_CLUSTER_MAX_ZOOM', 14))
+app.config['VIEWPORT_CLUSTER_PIXELS'] = int(os.getenv('VIEWPORT_CLUSTER_PIXELS', 64))
+app.config['VIEWPORT_MAX_ITEMS'] = int(os.getenv('VIEWPORT_MAX_ITEMS', 1000))
 
 if _testing:
     app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
@@ -32,17 +91,70 @@ if _testing:
             'options': '-c statement_timeout=60000'
         }
     }
+    _replica_urls = os.getenv('TEST_REPLICA_DATABASE_URLS', '')
+    _replica_engine_options = app.config['SQLALCHEMY_ENGINE_OPTIONS']
+else:
+    # Threaded workers need a connection per concurrent task
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'pool_size': int(os.getenv('SQLALCHEMY_POOL_SIZE', 5)),
+        'max_overflow': int(os.getenv('SQLALCHEMY_MAX_OVERFLOW', 10)),
+        'pool_pre_ping': True,
+        'pool_recycle': int(os.getenv('SQLALCHEMY_POOL_RECYCLE', 1800)),
+        'connect_args': {
+            'connect_timeout': 10,
+            'options': f"-c statement_timeout={int(os.getenv('DB_STATEMENT_TIMEOUT_MS', 30000))}"
+        }
+    }
+    _replica_urls = os.getenv('DATABASE_REPLICA_URLS', '')
+    _replica_engine_options = {
+        'pool_size': int(os.getenv('REPLICA_POOL_SIZE', 10)),
+        'max_overflow': int(os.getenv('REPLICA_MAX_OVERFLOW', 10)),
+        'pool_pre_ping': True,
+        'pool_recycle': int(os.getenv('SQLALCHEMY_POOL_RECYCLE', 1800)),
+        'connect_args': {
+            'connect_timeout': 10,
+            'options': f"-c statement_timeout={int(os.getenv('REPLICA_STATEMENT_TIMEOUT_MS', 10000))}"
+        }
+    }
+
+# Read replicas, used by @read_only endpoints (see replicas.py)
+app.config['SQLALCHEMY_BINDS'] = {
+    f'replica_{i}': dict(_replica_engine_options, url=url.strip())
+    for i, url in enumerate(u for u in _replica_urls.split(',') if u.strip())
+}
+app.config['REPLICA_BINDS'] = list(app.config['SQLALCHEMY_BINDS'])
+app.config['REPLICA_READ_YOUR_WRITES_SECONDS'] = int(os.getenv('REPLICA_READ_YOUR_WRITES_SECONDS', 10))
+app.config['METRICS_ENABLED'] = os.getenv('METRICS_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+app.config['METRICS_TOKEN'] = os.getenv('METRICS_TOKEN')
+app.config['METRICS_WORKER_PORT'] = int(os.getenv('METRICS_WORKER_PORT', 0))
+app.config['SLOW_REQUEST_MS'] = float(os.getenv('SLOW_REQUEST_MS', 0))
 
 
 db.init_app(app)
+bcrypt.init_app(app)
+metrics.init_app(app)
 jwt = JWTManager(app)
 
 if _testing:
     celery = None
 else:
     celery = make_celery(app)
+    # Image generation can be served by a separate high-concurrency worker, see README
+    celery.conf.task_routes = {
+        'tasks.generate_location_image': {'queue': app.config['GENERATION_QUEUE']},
+        'tasks.store_location_image': {'queue': app.config['GENERATION_QUEUE']},
+    }
+    if app.config['PING_INGESTION_ENABLED']:
+        celery.conf.beat_schedule = {
+            'drain-location-pings': {
+                'task': 'tasks.drain_location_pings',
+                'schedule': app.config['PING_DRAIN_SECONDS'],
+            },
+        }
 
 app.register_blueprint(bp)
+app.cli.add_command(import_locations_command)
+app.cli.add_command(migrate_command)
 
 swagger_config = {
     "headers": [],
@@ -0,0 +1,95 @@
+"""Radius-query latency: in-process GridIndex vs numpy full scan vs PostGIS.
+
+    python bench_spatial_index.py                      # in-memory only
+    BENCH_DATABASE_URL=postgresql://... python bench_spatial_index.py
+
+With BENCH_DATABASE_URL set, the same points are loaded into a temporary PostGIS table
+with the geography expression index used by /api/context and queried with ST_DWithin.
+"""
+import os
+import statistics
+import time
+import numpy as np
+from spatial_index import GridIndex, EARTH_RADIUS_M
+
+SIZES = (100_000, 1_000_000)
+RADII = (500, 1000, 5000)
+QUERIES = 200
+# Europe-sized bounding box, so density resembles a real catalogue
+LAT_RANGE, LNG_RANGE = (36.0, 60.0), (-10.0, 30.0)
+
+
+def timed(fn, points):
+    samples = []
+    for lat, lng in points:
+        started = time.perf_counter()
+        fn(lat, lng)
+        samples.append((time.perf_counter() - started) * 1000)
+    samples.sort()
+    return statistics.median(samples), samples[int(len(samples) * 0.99) - 1]
+
+
+def full_scan(lats, lngs, ids):
+    lat2, lng2 = np.radians(lats), np.radians(lngs)
+
+    def query(lat, lng, radius):
+        lat1, lng1 = np.radians(lat), np.radians(lng)
+        a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+        return ids[2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(a)) <= radius]
+    return query
+
+
+def postgis(url, ids, lats, lngs):
+    import psycopg2
+    conn = psycopg2.connect(url)
+    cur = conn.cursor()
+    cur.execute("CREATE TEMP TABLE bench_location (id integer primary key, coordinates geometry(POINT, 4326))")
+    cur.execute("""
+        INSERT INTO bench_location
+        SELECT id, ST_SetSRID(ST_MakePoint(lng, lat), 4326)
+        FROM unnest(%s::integer[], %s::float8[], %s::float8[]) AS t(id, lat, lng)
+    """, (ids.tolist(), lats.tolist(), lngs.tolist()))
+    cur.execute("CREATE INDEX ON bench_location USING gist (CAST(coordinates AS geography(POINT,4326)))")
+    cur.execute("ANALYZE bench_location")
+
+    def query(lat, lng, radius):
+        cur.execute("""
+            SELECT id FROM bench_location
+            WHERE ST_DWithin(CAST(coordinates AS geography(POINT,4326)),
+                             CAST(ST_SetSRID(ST_MakePoint(%s, %s), 4326) AS geography(POINT,4326)), %s)
+        """, (lng, lat, radius))
+        return cur.fetchall()
+    return query, conn
+
+
+def main():
+    rng = np.random.default_rng(42)
+    url = os.getenv('BENCH_DATABASE_URL')
+    if not url:
+        print("PostGIS skipped: set BENCH_DATABASE_URL to a PostGIS database to include it")
+    print(f"{'size':>9} {'radius':>7} {'engine':>10} {'p50 ms':>9} {'p99 ms':>9}")
+    for size in SIZES:
+        ids = np.arange(1, size + 1, dtype=np.int64)
+        lats = rng.uniform(*LAT_RANGE, size)
+        lngs = rng.uniform(*LNG_RANGE, size)
+        points = list(zip(rng.uniform(*LAT_RANGE, QUERIES), rng.uniform(*LNG_RANGE, QUERIES)))
+
+        started = time.perf_counter()
+        index = GridIndex(ids, lats, lngs, cell_degrees=0.01)
+        print(f"{size:>9} {'':>7} {'build':>10} {(time.perf_counter() - started) * 1000:>9.1f}")
+
+        engines = [('grid', index.ids_within), ('full scan', full_scan(lats, lngs, ids))]
+        conn = None
+        if url:
+            query, conn = postgis(url, ids, lats, lngs)
+            engines.append(('postgis', query))
+        for radius in RADII:
+            for name, fn in engines:
+                p50, p99 = timed(lambda lat, lng: fn(lat, lng, radius), points)
+                print(f"{size:>9} {radius:>7} {name:>10} {p50:>9.3f} {p99:>9.3f}")
+        if conn is not None:
+            conn.close()
+
+
+if __name__ == '__main__':
+    main()
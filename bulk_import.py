@@ -0,0 +1,200 @@
+import csv
+import io
+import json
+import time
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import text
+from extensions import db
+import context_cache
+import tile_cache
+import versions
+
+# Bulk location import. Records are read one at a time from NDJSON or CSV and written in
+# batches: location ids are reserved from the sequence up front, then every batch is one
+# multi-row INSERT over unnest()ed arrays for locations (points built by PostGIS) and one
+# for their snippets. A failing batch is retried row by row so a bad record only costs
+# itself, and each batch commits on its own.
+#
+# NDJSON: {"name": ..., "latitude": ..., "longitude": ...,
+#          "snippets": [{"title": ..., "description": ..., "type": ..., "source_url": ...}]}
+# CSV:    name,latitude,longitude[,snippet_title,snippet_description,snippet_type,snippet_source_url]
+
+MAX_REPORTED_ERRORS = 1000
+
+RESERVE_IDS = text(
+    "SELECT nextval(pg_get_serial_sequence('location', 'id')) FROM generate_series(1, :n)"
+)
+
+INSERT_LOCATIONS = text("""
+    INSERT INTO location (id, name, latitude, longitude, coordinates)
+    SELECT id, name, lat, lng, ST_SetSRID(ST_MakePoint(lng, lat), 4326)
+    FROM unnest(CAST(:ids AS integer[]), CAST(:names AS varchar[]),
+                CAST(:lats AS double precision[]), CAST(:lngs AS double precision[]))
+        AS t(id, name, lat, lng)
+""")
+
+INSERT_SNIPPETS = text("""
+    INSERT INTO context_snippet (location_id, title, description, type, source_url, photo_url)
+    SELECT * FROM unnest(CAST(:location_ids AS integer[]), CAST(:titles AS varchar[]),
+                         CAST(:descriptions AS text[]), CAST(:types AS varchar[]),
+                         CAST(:source_urls AS varchar[]), CAST(:photo_urls AS varchar[]))
+""")
+
+
+def _records_ndjson(lines):
+    for line_no, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        try:
+            yield line_no, json.loads(line)
+        except ValueError as e:
+            yield line_no, ValueError(f"Invalid JSON: {e}")
+
+
+def _records_csv(lines):
+    reader = csv.DictReader(lines)
+    for row in reader:
+        record = {'name': row.get('name'), 'latitude': row.get('latitude'), 'longitude': row.get('longitude')}
+        if row.get('snippet_title'):
+            record['snippets'] = [{
+                'title': row.get('snippet_title'),
+                'description': row.get('snippet_description'),
+                'type': row.get('snippet_type'),
+                'source_url': row.get('snippet_source_url') or None
+            }]
+        yield reader.line_num, record
+
+
+def _validate(record):
+    if not isinstance(record, dict):
+        raise ValueError("Record must be an object")
+    name = record.get('name')
+    if not isinstance(name, str) or not name.strip() or len(name.strip()) > 100:
+        raise ValueError("name is required and must be at most 100 characters")
+    try:
+        lat, lng = float(record['latitude']), float(record['longitude'])
+    except (KeyError, TypeError, ValueError):
+        raise ValueError("latitude and longitude must be numbers")
+    if not -90 <= lat <= 90 or not -180 <= lng <= 180:
+        raise ValueError("latitude/longitude out of range")
+    snippets = record.get('snippets') or []
+    if not isinstance(snippets, list):
+        raise ValueError("snippets must be a list")
+    for snippet in snippets:
+        if not isinstance(snippet, dict):
+            raise ValueError("snippets must be objects")
+        if not all(isinstance(snippet.get(field), str) and snippet[field] for field in ('title', 'description', 'type')):
+            raise ValueError("snippets need title, description and type")
+        if not all(isinstance(snippet.get(field), (str, type(None))) for field in ('source_url', 'photo_url')):
+            raise ValueError("snippet source_url and photo_url must be strings")
+    return {'name': name.strip(), 'latitude': lat, 'longitude': lng, 'snippets': snippets}
+
+
+def _insert(rows):
+    ids = [row[0] for row in db.session.execute(RESERVE_IDS, {'n': len(rows)})]
+    db.session.execute(INSERT_LOCATIONS, {
+        'ids': ids,
+        'names': [r['name'] for _, r in rows],
+        'lats': [r['latitude'] for _, r in rows],
+        'lngs': [r['longitude'] for _, r in rows],
+    })
+    snippets = [(location_id, s) for location_id, (_, r) in zip(ids, rows) for s in r['snippets']]
+    if snippets:
+        db.session.execute(INSERT_SNIPPETS, {
+            'location_ids': [location_id for location_id, _ in snippets],
+            'titles': [s['title'] for _, s in snippets],
+            'descriptions': [s['description'] for _, s in snippets],
+            'types': [s['type'] for _, s in snippets],
+            'source_urls': [s.get('source_url') for _, s in snippets],
+            'photo_urls': [s.get('photo_url') for _, s in snippets],
+        })
+    return ids
+
+
+def _flush(rows, report, enqueue):
+    try:
+        ids = _insert(rows)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        ids = []
+        for line_no, row in rows:
+            try:
+                ids.extend(_insert([(line_no, row)]))
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                _error(report, line_no, str(getattr(e, 'orig', e)).strip())
+    report['inserted'] += len(ids)
+    if enqueue:
+        chunk = current_app.config['IMPORT_ENQUEUE_CHUNK']
+        for start in range(0, len(ids), chunk):
+            enqueue(ids[start:start + chunk])
+
+
+def _error(report, line_no, message):
+    report['failed'] += 1
+    if len(report['errors']) < MAX_REPORTED_ERRORS:
+        report['errors'].append({'line': line_no, 'error': message})
+
+
+def import_locations(lines, fmt='ndjson', batch_size=None, enqueue=None):
+    """Import locations from an iterable of text lines and return a load report.
+
+    `enqueue` receives lists of new location ids for image generation.
+    """
+    batch_size = batch_size or current_app.config['IMPORT_BATCH_SIZE']
+    records = _records_csv(lines) if fmt == 'csv' else _records_ndjson(lines)
+    report = {'inserted': 0, 'failed': 0, 'errors': []}
+    started = time.monotonic()
+
+    rows = []
+    for line_no, record in records:
+        try:
+            if isinstance(record, Exception):
+                raise record
+            rows.append((line_no, _validate(record)))
+        except ValueError as e:
+            _error(report, line_no, str(e))
+            continue
+        if len(rows) >= batch_size:
+            _flush(rows, report, enqueue)
+            rows = []
+    if rows:
+        _flush(rows, report, enqueue)
+
+    if report['inserted']:
+        context_cache.invalidate_all()
+        tile_cache.invalidate_all()
+        versions.bump('locations')
+
+    elapsed = time.monotonic() - started
+    report['seconds'] = round(elapsed, 3)
+    report['rows_per_second'] = round(report['inserted'] / elapsed, 1) if elapsed else None
+    return report
+
+
+@click.command('import-locations')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'fmt', type=click.Choice(['ndjson', 'csv']), default=None,
+              help='Input format; defaults to the file extension.')
+@click.option('--batch-size', type=int, default=None, help='Rows per INSERT batch.')
+@click.option('--no-images', is_flag=True, help='Do not queue image generation.')
+@with_appcontext
+def import_locations_command(path, fmt, batch_size, no_images):
+    """Bulk import locations (and snippets) from an NDJSON or CSV file."""
+    fmt = fmt or ('csv' if path.lower().endswith('.csv') else 'ndjson')
+    enqueue = None
+    if not no_images:
+        from tasks import dispatch_image_batch
+        enqueue = dispatch_image_batch.delay
+    with io.open(path, encoding='utf-8', newline='') as f:
+        report = import_locations(f, fmt=fmt, batch_size=batch_size, enqueue=enqueue)
+    for error in report['errors']:
+        click.echo(f"line {error['line']}: {error['error']}", err=True)
+    click.echo(
+        f"Imported {report['inserted']} locations, {report['failed']} failed "
+        f"in {report['seconds']}s ({report['rows_per_second']} rows/s)"
+    )
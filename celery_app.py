@@ -1,4 +1,6 @@
 from celery import Celery
+from celery.signals import worker_init
+import metrics
 
 def make_celery(app=None):
     celery = Celery(
@@ -9,8 +11,15 @@ def make_celery(app=None):
 
     class ContextTask(celery.Task):
         def __call__(self, *args, **kwargs):
-            with app.app_context():
+            with app.app_context(), metrics.timed_task(self.name):
                 return self.run(*args, **kwargs)
 
     celery.Task = ContextTask
+
+    @worker_init.connect(weak=False)
+    def start_metrics_server(**kwargs):
+        # Solo and thread pools run tasks in this process; prefork children are not covered
+        if app.config['METRICS_WORKER_PORT']:
+            metrics.start_http_server(app.config['METRICS_WORKER_PORT'])
+
     return celery
\ No newline at end of file
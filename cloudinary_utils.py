@@ -1,15 +1,88 @@
+import io
+import os
 import cloudinary
 import cloudinary.uploader
 from flask import current_app
+import metrics
+
+_configured = False
+
 
 def configure_cloudinary():
+    global _configured
+    if _configured:
+        return
     cloudinary.config(
         cloud_name=current_app.config['CLOUDINARY_CLOUD_NAME'],
         api_key=current_app.config['CLOUDINARY_API_KEY'],
         api_secret=current_app.config['CLOUDINARY_API_SECRET']
     )
+    _configured = True
+
 
 def upload_image(file_path, public_id=None):
     configure_cloudinary()
-    response = cloudinary.uploader.upload(file_path, public_id=public_id)
-    return response['secure_url']
\ No newline at end of file
+    with metrics.timed_call('cloudinary', 'upload'):
+        response = cloudinary.uploader.upload(file_path, public_id=public_id)
+    return response['secure_url']
+
+
+class _SizedStream(io.RawIOBase):
+    """Forward-only stream over an HTTP body with a known Content-Length.
+
+    `upload_large` probes the size with seek(0, SEEK_END)/tell() before reading chunks;
+    that probe is answered from the declared length, any other seek is unsupported.
+    """
+
+    def __init__(self, raw, size, name):
+        self.raw = raw
+        self.size = size
+        self.name = name
+        self.position = 0
+        self.at_end = False
+
+    def readable(self):
+        return True
+
+    def read(self, n=-1):
+        if n is None or n < 0:
+            data = self.raw.read()
+        else:
+            # A socket read may return less than asked; Cloudinary needs full chunks but the last
+            parts = []
+            remaining = n
+            while remaining:
+                part = self.raw.read(remaining)
+                if not part:
+                    break
+                parts.append(part)
+                remaining -= len(part)
+            data = b''.join(parts)
+        self.position += len(data)
+        return data
+
+    def tell(self):
+        return self.size if self.at_end else self.position
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_END and offset == 0:
+            self.at_end = True
+            return self.size
+        if whence == os.SEEK_SET and offset == self.position:
+            self.at_end = False
+            return self.position
+        raise io.UnsupportedOperation("stream is forward-only")
+
+
+def upload_stream(stream, size, public_id=None):
+    """Upload a file-like body of `size` bytes in bounded chunks without buffering it whole."""
+    configure_cloudinary()
+    # Includes reading the source body, which is streamed through the upload
+    with metrics.timed_call('cloudinary', 'upload_stream'):
+        response = cloudinary.uploader.upload_large(
+            _SizedStream(stream, size, name=f"{public_id or 'stream'}.png"),
+            public_id=public_id,
+            resource_type='image',
+            chunk_size=current_app.config['CLOUDINARY_UPLOAD_CHUNK_SIZE']
+        )
+    return response['secure_url']
@@ -0,0 +1,140 @@
+import json
+import math
+from collections import namedtuple
+from flask import current_app
+import redis
+from extensions import get_redis
+from geo_utils import haversine_metres
+
+# Responses are cached per grid cell and radius bucket. Each entry holds every location
+# within `bucket + half cell diagonal` of the cell centre, so any request inside the cell
+# with a radius up to the bucket can be answered from the entry by a distance filter.
+# An entry also records the 'locations' version read before it was built; responses served
+# from it carry that version in their ETag, so an entry that raced a write (filled from rows
+# read before the write, stored after its invalidation) can never pass as the newer version.
+
+METRES_PER_DEGREE = 111320.0
+KEY_PREFIX = 'context:'
+HITS_KEY = 'context:stats:hits'
+MISSES_KEY = 'context:stats:misses'
+
+Cell = namedtuple('Cell', ['key', 'lat', 'lng', 'radius'])
+
+
+def _cell_size():
+    return current_app.config['CONTEXT_CACHE_CELL_DEGREES']
+
+
+def _search_radius(bucket):
+    # 1% slack covers the spheroid (PostGIS) vs sphere (haversine) difference
+    half_diagonal = _cell_size() * METRES_PER_DEGREE * math.sqrt(2) / 2
+    return (bucket + half_diagonal) * 1.01
+
+
+def cell_for(lat, lng, radius):
+    """Cache cell for a request, or None when the request is not cacheable."""
+    if get_redis() is None:
+        return None
+    buckets = [b for b in current_app.config['CONTEXT_CACHE_RADIUS_BUCKETS'] if b >= radius]
+    if not buckets:
+        return None
+    bucket = min(buckets)
+    size = _cell_size()
+    i, j = math.floor(lat / size), math.floor(lng / size)
+    return Cell(
+        key=f'{KEY_PREFIX}{bucket}:{i}:{j}',
+        lat=(i + 0.5) * size,
+        lng=(j + 0.5) * size,
+        radius=_search_radius(bucket)
+    )
+
+
+def within(locations, lat, lng, radius):
+    return [
+        loc for loc in locations
+        if haversine_metres(lat, lng, loc['coordinates']['lat'], loc['coordinates']['lng']) <= radius
+    ]
+
+
+def get(cell):
+    """The cached entry, {'version': ..., 'locations': [...]}, or None on a miss."""
+    client = get_redis()
+    try:
+        cached = client.get(cell.key)
+        client.incr(HITS_KEY if cached is not None else MISSES_KEY)
+    except redis.RedisError as e:
+        current_app.logger.warning(f"Context cache read failed: {e}")
+        return None
+    return json.loads(cached) if cached is not None else None
+
+
+def put(cell, version, locations):
+    if version is None:
+        return
+    try:
+        get_redis().set(cell.key, json.dumps({'version': version, 'locations': locations}),
+                        ex=current_app.config['CONTEXT_CACHE_TTL'])
+    except redis.RedisError as e:
+        current_app.logger.warning(f"Context cache write failed: {e}")
+
+
+def invalidate_location(lat, lng):
+    """Drop every cached cell whose search area contains the point (lat, lng)."""
+    client = get_redis()
+    if client is None:
+        return
+    size = _cell_size()
+    keys = []
+    for bucket in current_app.config['CONTEXT_CACHE_RADIUS_BUCKETS']:
+        reach = _search_radius(bucket)
+        dlat = reach / METRES_PER_DEGREE
+        dlng = dlat / max(math.cos(math.radians(lat)), 0.01)
+        for i in range(math.floor((lat - dlat) / size), math.floor((lat + dlat) / size) + 1):
+            for j in range(math.floor((lng - dlng) / size), math.floor((lng + dlng) / size) + 1):
+                if haversine_metres(lat, lng, (i + 0.5) * size, (j + 0.5) * size) <= reach:
+                    keys.append(f'{KEY_PREFIX}{bucket}:{i}:{j}')
+    try:
+        pipe = client.pipeline(transaction=False)
+        for start in range(0, len(keys), 500):
+            pipe.unlink(*keys[start:start + 500])
+        pipe.execute()
+    except redis.RedisError as e:
+        current_app.logger.warning(f"Context cache invalidation failed: {e}")
+
+
+def invalidate_all():
+    """Drop every cached cell, for bulk writes where per-point invalidation would cost more."""
+    client = get_redis()
+    if client is None:
+        return
+    try:
+        batch = []
+        for key in client.scan_iter(match=f'{KEY_PREFIX}[0-9]*', count=1000):
+            batch.append(key)
+            if len(batch) >= 500:
+                client.unlink(*batch)
+                batch = []
+        if batch:
+            client.unlink(*batch)
+    except redis.RedisError as e:
+        current_app.logger.warning(f"Context cache invalidation failed: {e}")
+
+
+def stats():
+    client = get_redis()
+    if client is None:
+        return {'enabled': False}
+    result = {
+        'enabled': True,
+        'cell_degrees': _cell_size(),
+        'radius_buckets': current_app.config['CONTEXT_CACHE_RADIUS_BUCKETS'],
+        'ttl': current_app.config['CONTEXT_CACHE_TTL']
+    }
+    try:
+        hits, misses = (int(v or 0) for v in client.mget(HITS_KEY, MISSES_KEY))
+    except redis.RedisError as e:
+        current_app.logger.warning(f"Context cache stats read failed: {e}")
+        return result
+    total = hits + misses
+    result.update({'hits': hits, 'misses': misses, 'hit_rate': hits / total if total else None})
+    return result
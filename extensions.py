@@ -1,2 +1,37 @@
+from flask import current_app, g, has_request_context
 from flask_sqlalchemy import SQLAlchemy
-db = SQLAlchemy()
\ No newline at end of file
+from flask_sqlalchemy.session import Session
+import redis
+
+
+class RoutingSession(Session):
+    """Session that reads from the replica bind chosen for the request, if any.
+
+    `replicas.read_only` sets `g.db_replica`; flushes and every other request use the primary.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and has_request_context():
+            replica = g.get('db_replica')
+            if replica is not None:
+                g.db_replica_used = True
+                return self._db.engines[replica]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+db = SQLAlchemy(session_options={'class_': RoutingSession})
+
+_redis_clients = {}
+
+
+def get_redis():
+    """Shared Redis client for the configured REDIS_URL, or None when Redis is not configured."""
+    url = current_app.config.get('REDIS_URL')
+    if not url:
+        return None
+    client = _redis_clients.get(url)
+    if client is None:
+        client = _redis_clients[url] = redis.Redis.from_url(
+            url, socket_timeout=1, socket_connect_timeout=1
+        )
+    return client
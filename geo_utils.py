@@ -0,0 +1,55 @@
+import math
+from sqlalchemy import bindparam, cast, func, select, true, Float
+from sqlalchemy.dialects.postgresql import ARRAY
+from geoalchemy2 import Geography
+from extensions import db
+from models import Location, location_geography
+
+
+def geography_point(lat, lng):
+    return cast(func.ST_SetSRID(func.ST_MakePoint(lng, lat), 4326), Geography('POINT', srid=4326))
+
+
+def within_metres(lat, lng, radius):
+    # Must compare against `location_geography` exactly so the expression index is used
+    return func.ST_DWithin(location_geography, geography_point(lat, lng), radius)
+
+
+def nearest_first(lat, lng):
+    # KNN ordering: with a LIMIT the geography index is walked nearest-first instead of
+    # sorting every row by distance
+    return location_geography.op('<->')(geography_point(lat, lng))
+
+
+def distance_metres(lat, lng):
+    return func.ST_Distance(location_geography, geography_point(lat, lng))
+
+
+EARTH_RADIUS_M = 6371008.8
+
+
+def haversine_metres(lat1, lng1, lat2, lng2):
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    a = (math.sin((lat2 - lat1) / 2) ** 2
+         + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_M * math.asin(math.sqrt(a))
+
+
+def nearby_pairs(points):
+    """(point index, location id) for every location within radius of each (lat, lng, radius).
+
+    All points are answered by one query: a LATERAL join of the radius search over the
+    unnested point arrays, each probe using the geography index.
+    """
+    table = func.unnest(
+        bindparam('lats', [p[0] for p in points], type_=ARRAY(Float)),
+        bindparam('lngs', [p[1] for p in points], type_=ARRAY(Float)),
+        bindparam('radii', [p[2] for p in points], type_=ARRAY(Float)),
+    ).table_valued('lat', 'lng', 'radius', with_ordinality='idx').render_derived().alias('p')
+    nearby = select(Location.id).where(
+        within_metres(table.c.lat, table.c.lng, table.c.radius)
+    ).lateral('l')
+    rows = db.session.execute(
+        select(table.c.idx, nearby.c.id).select_from(table.join(nearby, true()))
+    )
+    return [(idx - 1, location_id) for idx, location_id in rows]
@@ -0,0 +1,40 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
+
+# Password hashing runs on a small dedicated thread pool (bcrypt releases the GIL), so a
+# burst of logins cannot occupy every request thread. At most HASHING_WORKERS hashes run
+# and HASHING_QUEUE more wait; beyond that callers get HashingBusy instead of queueing.
+
+
+class HashingBusy(Exception):
+    pass
+
+
+_executor = None
+_slots = None
+_init_lock = threading.Lock()
+
+
+def _pool():
+    global _executor, _slots
+    if _executor is None:
+        with _init_lock:
+            if _executor is None:
+                workers = current_app.config['HASHING_WORKERS']
+                _slots = threading.BoundedSemaphore(workers + current_app.config['HASHING_QUEUE'])
+                _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='hashing')
+    return _executor, _slots
+
+
+def run(fn, *args):
+    executor, slots = _pool()
+    if not slots.acquire(timeout=current_app.config['HASHING_QUEUE_TIMEOUT']):
+        raise HashingBusy()
+    try:
+        future = executor.submit(fn, *args)
+    except Exception:
+        slots.release()
+        raise
+    future.add_done_callback(lambda _: slots.release())
+    return future.result()
@@ -0,0 +1,70 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+from flask import current_app
+import redis
+from extensions import db, get_redis
+from models import User
+
+# Short-lived cache of {'exists': bool, 'is_admin': bool} per user id, so authenticated routes
+# can check a user still exists and still has their role without a DB round-trip on every
+# request. Entries live IDENTITY_CACHE_TTL seconds in-process (at most
+# IDENTITY_CACHE_MAX_ENTRIES of them, oldest dropped first) and IDENTITY_CACHE_REDIS_TTL
+# seconds in Redis; invalidate() clears this process and Redis, other processes catch up
+# within the in-process TTL.
+
+KEY = 'identity:{}'
+_MISSING = {'exists': False}
+
+_local = OrderedDict()
+_lock = threading.Lock()
+
+
+def _from_db(user_id):
+    row = db.session.query(User.is_admin).filter_by(id=user_id).first()
+    return {'exists': True, 'is_admin': bool(row.is_admin)} if row else _MISSING
+
+
+def get_identity(user_id):
+    """Cached {'exists': True, 'is_admin': bool} for the user, or None if the user does not exist."""
+    now = time.monotonic()
+    with _lock:
+        cached = _local.get(user_id)
+    if cached and cached[0] > now:
+        identity = cached[1]
+    else:
+        identity = None
+        client = get_redis()
+        if client is not None:
+            try:
+                raw = client.get(KEY.format(user_id))
+                identity = json.loads(raw) if raw is not None else None
+            except redis.RedisError as e:
+                current_app.logger.warning(f"Identity cache read failed: {e}")
+        if identity is None:
+            identity = _from_db(user_id)
+            if client is not None:
+                try:
+                    client.set(KEY.format(user_id), json.dumps(identity),
+                               ex=current_app.config['IDENTITY_CACHE_REDIS_TTL'])
+                except redis.RedisError as e:
+                    current_app.logger.warning(f"Identity cache write failed: {e}")
+        with _lock:
+            _local[user_id] = (now + current_app.config['IDENTITY_CACHE_TTL'], identity)
+            _local.move_to_end(user_id)
+            while len(_local) > current_app.config['IDENTITY_CACHE_MAX_ENTRIES']:
+                _local.popitem(last=False)
+    return identity if identity['exists'] else None
+
+
+def invalidate(user_id):
+    with _lock:
+        _local.pop(user_id, None)
+    client = get_redis()
+    if client is None:
+        return
+    try:
+        client.delete(KEY.format(user_id))
+    except redis.RedisError as e:
+        current_app.logger.warning(f"Identity cache invalidation failed: {e}")
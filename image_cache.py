@@ -0,0 +1,75 @@
+import hashlib
+from flask import current_app
+import redis
+from sqlalchemy.dialects.postgresql import insert
+from extensions import db, get_redis
+from models import GeneratedImage
+
+HITS_KEY = 'image_cache:stats:hits'
+MISSES_KEY = 'image_cache:stats:misses'
+
+
+def prompt_key(model, prompt):
+    return hashlib.sha256(f"{model}\n{prompt}".encode('utf-8')).hexdigest()
+
+
+def _count(key):
+    client = get_redis()
+    if client is None:
+        return
+    try:
+        client.incr(key)
+    except redis.RedisError as e:
+        current_app.logger.warning(f"Image cache stats update failed: {e}")
+
+
+def lookup(key):
+    """Stored URL for a prompt key, or None if the image has to be generated."""
+    url = db.session.execute(
+        db.update(GeneratedImage)
+        .where(GeneratedImage.prompt_hash == key)
+        .values(hits=GeneratedImage.hits + 1)
+        .returning(GeneratedImage.url)
+    ).scalar()
+    _count(HITS_KEY if url else MISSES_KEY)
+    return url
+
+
+def remember(key, model, prompt, url):
+    db.session.execute(
+        insert(GeneratedImage)
+        .values(prompt_hash=key, model=model, prompt=prompt, url=url)
+        .on_conflict_do_nothing(index_elements=['prompt_hash'])
+    )
+
+
+def stats():
+    entries, reused = db.session.query(
+        db.func.count(GeneratedImage.prompt_hash),
+        db.func.coalesce(db.func.sum(GeneratedImage.hits), 0)
+    ).one()
+    result = {'entries': entries, 'reused': int(reused)}
+    client = get_redis()
+    if client is None:
+        return result
+    try:
+        hits, misses = (int(v or 0) for v in client.mget(HITS_KEY, MISSES_KEY))
+    except redis.RedisError as e:
+        current_app.logger.warning(f"Image cache stats read failed: {e}")
+        return result
+    total = hits + misses
+    result.update({'hits': hits, 'misses': misses, 'hit_rate': hits / total if total else None})
+    return result
+
+
+def purge():
+    deleted = db.session.query(GeneratedImage).delete()
+    db.session.commit()
+    client = get_redis()
+    if client is None:
+        return deleted
+    try:
+        client.delete(HITS_KEY, MISSES_KEY)
+    except redis.RedisError as e:
+        current_app.logger.warning(f"Image cache stats reset failed: {e}")
+    return deleted
@@ -0,0 +1,45 @@
+from flask import current_app
+import redis
+from extensions import get_redis
+
+# One lease per location marks an image generation as pending or running. It is shared by
+# every web process and worker through Redis and expires after IMAGE_GENERATION_LEASE_TTL
+# in case the holder dies. A failed generation keeps the lease for IMAGE_FAILURE_COOLDOWN
+# instead of releasing it, so a location that always fails (a refused prompt, say) is not
+# sent to Replicate again on every nearby ping.
+
+LEASE_KEY = 'image_generation:lease:{}'
+
+
+def acquire_image_lease(location_id):
+    client = get_redis()
+    if client is None:
+        return True
+    try:
+        return bool(client.set(
+            LEASE_KEY.format(location_id), 1,
+            nx=True, ex=current_app.config['IMAGE_GENERATION_LEASE_TTL']
+        ))
+    except redis.RedisError as e:
+        current_app.logger.warning(f"Image generation lease check failed: {e}")
+        return True
+
+
+def release_image_lease(location_id):
+    client = get_redis()
+    if client is None:
+        return
+    try:
+        client.delete(LEASE_KEY.format(location_id))
+    except redis.RedisError as e:
+        current_app.logger.warning(f"Image generation lease release failed: {e}")
+
+
+def hold_image_lease_after_failure(location_id):
+    client = get_redis()
+    if client is None:
+        return
+    try:
+        client.set(LEASE_KEY.format(location_id), 1, ex=current_app.config['IMAGE_FAILURE_COOLDOWN'])
+    except redis.RedisError as e:
+        current_app.logger.warning(f"Image generation failure cooldown failed: {e}")
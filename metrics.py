@@ -0,0 +1,223 @@
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from flask import Response, abort, current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# In-process metrics exported in the Prometheus text format, without a client library.
+# Web requests, SQL statements, Celery tasks and calls to Replicate/Cloudinary are timed
+# into histograms; /metrics serves the web process, and a worker can serve its own on
+# METRICS_WORKER_PORT. Values are per process and reset on restart.
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SLOW_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+COUNT_BUCKETS = (1, 2, 3, 5, 10, 20, 50, 100)
+MAX_LOGGED_STATEMENTS = 50
+
+_lock = threading.Lock()
+_metrics = []
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name, self.help, self.label_names = name, help, tuple(labels)
+        self.values = {}
+        _metrics.append(self)
+
+    def inc(self, *labels, amount=1):
+        with _lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        for labels, value in sorted(self.values.items()):
+            lines.append(f'{self.name}{_labels(self.label_names, labels)} {value}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name, self.help, self.label_names = name, help, tuple(labels)
+        self.buckets = tuple(buckets)
+        self.values = {}
+        _metrics.append(self)
+
+    def observe(self, value, *labels):
+        with _lock:
+            counts, total = self.values.get(labels, ([0] * (len(self.buckets) + 1), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-1] += 1
+            self.values[labels] = (counts, total + value)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        for labels, (counts, total) in sorted(self.values.items()):
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                lines.append(f'{self.name}_bucket{_labels(self.label_names, labels, [("le", bound)])} {count}')
+            lines.append(f'{self.name}_sum{_labels(self.label_names, labels)} {total}')
+            lines.append(f'{self.name}_count{_labels(self.label_names, labels)} {counts[-1]}')
+        return lines
+
+
+def render():
+    with _lock:
+        lines = [line for metric in _metrics for line in metric.render()]
+    return '\n'.join(lines) + '\n'
+
+
+http_requests = Counter('http_requests_total', 'HTTP requests by route and status.',
+                        ['method', 'endpoint', 'status'])
+http_request_duration = Histogram('http_request_duration_seconds', 'HTTP request latency by route.',
+                                  ['method', 'endpoint'])
+http_request_queries = Histogram('http_request_db_queries', 'SQL statements per HTTP request.',
+                                 ['endpoint'], buckets=COUNT_BUCKETS)
+db_query_duration = Histogram('db_query_duration_seconds', 'SQL statement latency by database.',
+                              ['database'])
+task_duration = Histogram('celery_task_duration_seconds', 'Celery task run time by outcome.',
+                          ['task', 'outcome'], buckets=SLOW_BUCKETS)
+outbound_duration = Histogram('outbound_call_duration_seconds', 'Calls to external services.',
+                              ['service', 'operation', 'outcome'], buckets=SLOW_BUCKETS)
+
+
+@contextmanager
+def timed_call(service, operation):
+    """Time a call to an external service into outbound_call_duration_seconds."""
+    started = time.perf_counter()
+    outcome = 'error'
+    try:
+        yield
+        outcome = 'ok'
+    finally:
+        outbound_duration.observe(time.perf_counter() - started, service, operation, outcome)
+
+
+@contextmanager
+def timed_task(name):
+    started = time.perf_counter()
+    outcome = 'failure'
+    try:
+        yield
+        outcome = 'success'
+    except Exception as e:
+        # celery.exceptions.Retry, matched by name to keep this module free of Celery
+        if type(e).__name__ == 'Retry':
+            outcome = 'retry'
+        raise
+    finally:
+        task_duration.observe(time.perf_counter() - started, name, outcome)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['query_started'].pop()
+    db_query_duration.observe(elapsed, conn.engine.url.database or '')
+    if has_request_context() and 'metrics_started' in g:
+        g.metrics_query_count += 1
+        if current_app.config['SLOW_REQUEST_MS'] and len(g.metrics_statements) < MAX_LOGGED_STATEMENTS:
+            g.metrics_statements.append((elapsed, statement))
+
+
+@event.listens_for(Engine, 'handle_error')
+def _handle_error(context):
+    if context.connection is not None and context.connection.info.get('query_started'):
+        context.connection.info['query_started'].pop()
+
+
+def _before_request():
+    g.metrics_started = time.perf_counter()
+    g.metrics_query_count = 0
+    g.metrics_statements = []
+
+
+def _after_request(response):
+    g.metrics_status = response.status_code
+    return response
+
+
+def _teardown_request(exc):
+    if 'metrics_started' not in g:
+        return
+    elapsed = time.perf_counter() - g.metrics_started
+    endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+    status = g.get('metrics_status', 500) if exc is None else 500
+    http_requests.inc(request.method, endpoint, status)
+    http_request_duration.observe(elapsed, request.method, endpoint)
+    http_request_queries.observe(g.metrics_query_count, endpoint)
+
+    slow_ms = current_app.config['SLOW_REQUEST_MS']
+    if slow_ms and elapsed * 1000 >= slow_ms:
+        statements = ''.join(
+            f"\n  {duration * 1000:.1f} ms  {' '.join(statement.split())}"
+            for duration, statement in g.metrics_statements
+        )
+        current_app.logger.warning(
+            f"Slow request {request.method} {request.full_path.rstrip('?')} -> {status} "
+            f"in {elapsed * 1000:.0f} ms, {g.metrics_query_count} queries{statements}"
+        )
+
+
+def metrics_view():
+    """
+    Prometheus metrics for this web process
+    ---
+    tags:
+      - General
+    responses:
+      200:
+        description: Request, SQL, task and outbound call metrics in the Prometheus text format
+      401:
+        description: METRICS_TOKEN is set and the request does not carry it as a Bearer token
+    """
+    token = current_app.config['METRICS_TOKEN']
+    if token and request.headers.get('Authorization') != f'Bearer {token}':
+        abort(401)
+    return Response(render(), mimetype='text/plain; version=0.0.4')
+
+
+def init_app(app):
+    if not app.config['METRICS_ENABLED']:
+        return
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.teardown_request(_teardown_request)
+    app.add_url_rule('/metrics', 'metrics', metrics_view)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_http_server(port):
+    """Serve this process's metrics on a background thread, for Celery workers."""
+    server = ThreadingHTTPServer(('0.0.0.0', port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True, name='metrics-http').start()
+    return server
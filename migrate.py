@@ -0,0 +1,104 @@
+import os
+import re
+import click
+from flask.cli import with_appcontext
+from extensions import db
+
+# Versioned SQL migrations: migrations/NNNN_name.sql files are applied in order and
+# recorded in schema_version. Each file runs in one transaction, except files whose first
+# line is "-- migrate: no-transaction" (CREATE INDEX CONCURRENTLY), which run statement by
+# statement in autocommit. An advisory lock keeps concurrent deploys from racing.
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+NO_TRANSACTION = '-- migrate: no-transaction'
+LOCK_ID = 7284011
+
+_FILENAME = re.compile(r'^(\d+)_(\w+)\.sql$')
+
+
+def available():
+    migrations = []
+    for filename in sorted(os.listdir(MIGRATIONS_DIR)):
+        match = _FILENAME.match(filename)
+        if match:
+            migrations.append((int(match.group(1)), match.group(2), os.path.join(MIGRATIONS_DIR, filename)))
+    return migrations
+
+
+def _statements(sql):
+    lines = [line for line in sql.splitlines() if not line.lstrip().startswith('--')]
+    return [statement.strip() for statement in '\n'.join(lines).split(';') if statement.strip()]
+
+
+def applied(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            name VARCHAR(200) NOT NULL,
+            applied_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now()
+        )
+    """)
+    cursor.execute("SELECT version FROM schema_version")
+    return {row[0] for row in cursor.fetchall()}
+
+
+def migrate(echo=print):
+    """Apply pending migrations and return their versions."""
+    pooled = db.engine.raw_connection()
+    # Detached so the autocommit connection is closed rather than returned to the pool;
+    # autocommit must be set on the DBAPI connection, the pool proxy does not forward it
+    pooled.detach()
+    conn = pooled.dbapi_connection
+    try:
+        conn.autocommit = True
+        cursor = conn.cursor()
+        cursor.execute("SELECT pg_advisory_lock(%s)", (LOCK_ID,))
+        try:
+            done = applied(cursor)
+            pending = [m for m in available() if m[0] not in done]
+            for version, name, path in pending:
+                echo(f"Applying {version:04d}_{name}")
+                with open(path, encoding='utf-8') as f:
+                    sql = f.read()
+                record = ("INSERT INTO schema_version (version, name) VALUES (%s, %s)", (version, name))
+                if sql.startswith(NO_TRANSACTION):
+                    # Every statement must be idempotent: a failure part way is retried from the top
+                    for statement in _statements(sql):
+                        cursor.execute(statement)
+                    cursor.execute(*record)
+                else:
+                    conn.autocommit = False
+                    try:
+                        cursor.execute(sql)
+                        cursor.execute(*record)
+                        conn.commit()
+                    except Exception:
+                        conn.rollback()
+                        raise
+                    finally:
+                        conn.autocommit = True
+            return [version for version, _, _ in pending]
+        finally:
+            cursor.execute("SELECT pg_advisory_unlock(%s)", (LOCK_ID,))
+    finally:
+        conn.close()
+
+
+@click.command('migrate')
+@click.option('--status', is_flag=True, help='List migrations and whether they are applied.')
+@with_appcontext
+def migrate_command(status):
+    """Apply pending SQL migrations from migrations/."""
+    if status:
+        conn = db.engine.raw_connection()
+        try:
+            cursor = conn.cursor()
+            done = applied(cursor)
+            conn.commit()
+        finally:
+            conn.close()
+        for version, name, _ in available():
+            click.echo(f"{'applied' if version in done else 'pending':>8}  {version:04d}_{name}")
+        return
+    versions = migrate(echo=click.echo)
+    click.echo(f"Applied {len(versions)} migration(s)" if versions else "Schema is up to date")
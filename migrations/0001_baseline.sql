@@ -0,0 +1,44 @@
+-- Schema as created by db.create_all() before migrations were introduced; a no-op on
+-- existing databases.
+CREATE EXTENSION IF NOT EXISTS postgis;
+
+CREATE TABLE IF NOT EXISTS "user" (
+    id SERIAL PRIMARY KEY,
+    username VARCHAR(80) NOT NULL UNIQUE,
+    email VARCHAR(120) NOT NULL UNIQUE,
+    password_hash VARCHAR(128) NOT NULL,
+    is_admin BOOLEAN
+);
+
+CREATE TABLE IF NOT EXISTS location (
+    id SERIAL PRIMARY KEY,
+    name VARCHAR(100),
+    latitude FLOAT NOT NULL,
+    longitude FLOAT NOT NULL,
+    coordinates geometry(POINT, 4326)
+);
+CREATE INDEX IF NOT EXISTS idx_location_coordinates ON location USING gist (coordinates);
+
+CREATE TABLE IF NOT EXISTS context_snippet (
+    id SERIAL PRIMARY KEY,
+    title VARCHAR(150) NOT NULL,
+    description TEXT NOT NULL,
+    type VARCHAR(50) NOT NULL,
+    source_url VARCHAR(500),
+    photo_url VARCHAR(500),
+    location_id INTEGER NOT NULL REFERENCES location (id)
+);
+
+CREATE TABLE IF NOT EXISTS location_media (
+    id SERIAL PRIMARY KEY,
+    location_id INTEGER NOT NULL REFERENCES location (id),
+    media_type VARCHAR(20),
+    url VARCHAR(500),
+    created_at TIMESTAMP WITHOUT TIME ZONE
+);
+
+CREATE TABLE IF NOT EXISTS user_favorites (
+    user_id INTEGER NOT NULL REFERENCES "user" (id),
+    location_id INTEGER NOT NULL REFERENCES location (id),
+    PRIMARY KEY (user_id, location_id)
+);
@@ -0,0 +1,17 @@
+-- migrate: no-transaction
+-- Indexes behind the radius searches and the /admin/users filters, and the generated
+-- image cache table.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_location_coordinates_geography
+    ON location USING gist (CAST(coordinates AS geography(POINT, 4326)));
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_user_username_pattern ON "user" (username text_pattern_ops);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_user_email_pattern ON "user" (email text_pattern_ops);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_user_admin_id ON "user" (id) WHERE is_admin;
+
+CREATE TABLE IF NOT EXISTS generated_image (
+    prompt_hash VARCHAR(64) PRIMARY KEY,
+    model VARCHAR(100) NOT NULL,
+    prompt TEXT NOT NULL,
+    url VARCHAR(500) NOT NULL,
+    hits INTEGER NOT NULL,
+    created_at TIMESTAMP WITHOUT TIME ZONE
+);
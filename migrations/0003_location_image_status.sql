@@ -0,0 +1,11 @@
+-- Denormalized image state, so "does this location need an image" is a column read.
+ALTER TABLE location ADD COLUMN IF NOT EXISTS image_status VARCHAR(10) NOT NULL DEFAULT 'none';
+ALTER TABLE location DROP CONSTRAINT IF EXISTS ck_location_image_status;
+ALTER TABLE location ADD CONSTRAINT ck_location_image_status
+    CHECK (image_status IN ('none', 'pending', 'ready', 'failed'));
+
+UPDATE location SET image_status = 'ready'
+WHERE EXISTS (
+    SELECT 1 FROM location_media
+    WHERE location_media.location_id = location.id AND location_media.media_type = 'image'
+);
@@ -0,0 +1,6 @@
+-- migrate: no-transaction
+-- Snippet and media lookups by location (and type) become index scans.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_location_media_location_type
+    ON location_media (location_id, media_type);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_context_snippet_location_type
+    ON context_snippet (location_id, type);
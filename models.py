@@ -1,9 +1,14 @@
+import re
+from flask import current_app
 from extensions import db
 from flask_bcrypt import Bcrypt
-from geoalchemy2 import Geometry
+import hashing
+from geoalchemy2 import Geometry, Geography
 
 bcrypt = Bcrypt()
 
+BCRYPT_COST = re.compile(r'^\$2[abxy]?\$(\d\d)\$')
+
 
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -14,11 +19,24 @@ class User(db.Model):
 
     favorites = db.relationship('Location', secondary='user_favorites', backref='favorited_by')
 
+    # Back the /admin/users filters: prefix search on username/email and the admin flag
+    __table_args__ = (
+        db.Index('ix_user_username_pattern', 'username', postgresql_ops={'username': 'text_pattern_ops'}),
+        db.Index('ix_user_email_pattern', 'email', postgresql_ops={'email': 'text_pattern_ops'}),
+        db.Index('ix_user_admin_id', 'id', postgresql_where=db.text('is_admin')),
+    )
+
     def set_password(self, password):
-        self.password_hash = bcrypt.generate_password_hash(password).decode('utf-8')
+        rounds = current_app.config['BCRYPT_LOG_ROUNDS']
+        self.password_hash = hashing.run(bcrypt.generate_password_hash, password, rounds).decode('utf-8')
 
     def check_password(self, password):
-        return bcrypt.check_password_hash(self.password_hash, password)
+        return hashing.run(bcrypt.check_password_hash, self.password_hash, password)
+
+    def password_needs_rehash(self):
+        # bcrypt hashes look like $2b$<cost>$...; anything else is rehashed too
+        match = BCRYPT_COST.match(self.password_hash or '')
+        return not match or int(match.group(1)) != current_app.config['BCRYPT_LOG_ROUNDS']
 
 
 user_favorites = db.Table('user_favorites',
@@ -34,11 +52,28 @@ class Location(db.Model):
     longitude = db.Column(db.Float, nullable=False)
     snippets = db.relationship('ContextSnippet', backref='location', lazy=True)
     coordinates = db.Column(Geometry('POINT', srid=4326))
+    # Kept by the image tasks so "needs an image" is a column read: none, pending, ready or failed
+    image_status = db.Column(db.String(10), nullable=False, default='none', server_default='none')
+
+    __table_args__ = (
+        db.CheckConstraint("image_status IN ('none', 'pending', 'ready', 'failed')",
+                           name='ck_location_image_status'),
+    )
+
+    @classmethod
+    def set_image_status(cls, location_id, status):
+        cls.query.filter_by(id=location_id).update({'image_status': status}, synchronize_session=False)
 
     def __repr__(self):
         return f"Location('{self.name}', {self.latitude}, {self.longitude})"
 
 
+# Radius searches run on the geography cast of `coordinates` so distances are in
+# metres; the expression index lets the planner use a GiST index scan for them.
+location_geography = db.cast(Location.coordinates, Geography('POINT', srid=4326))
+db.Index('ix_location_coordinates_geography', location_geography, postgresql_using='gist')
+
+
 class ContextSnippet(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(150), nullable=False)
@@ -48,6 +83,10 @@ class ContextSnippet(db.Model):
     photo_url = db.Column(db.String(500))
     location_id = db.Column(db.Integer, db.ForeignKey('location.id'), nullable=False)
 
+    __table_args__ = (
+        db.Index('ix_context_snippet_location_type', 'location_id', 'type'),
+    )
+
     def __repr__(self):
         return f"ContextSnippet('{self.title}', '{self.type}')"
 
@@ -59,3 +98,17 @@ class LocationMedia(db.Model):
     url = db.Column(db.String(500))
     created_at = db.Column(db.DateTime, default=db.func.current_timestamp())
     location = db.relationship('Location', backref='media')
+
+    __table_args__ = (
+        db.Index('ix_location_media_location_type', 'location_id', 'media_type'),
+    )
+
+
+class GeneratedImage(db.Model):
+    # Content-addressed: sha256 of model id + prompt, so identical prompts reuse one upload
+    prompt_hash = db.Column(db.String(64), primary_key=True)
+    model = db.Column(db.String(100), nullable=False)
+    prompt = db.Column(db.Text, nullable=False)
+    url = db.Column(db.String(500), nullable=False)
+    hits = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, default=db.func.current_timestamp())
@@ -0,0 +1,108 @@
+import os
+import socket
+from flask import current_app
+import redis
+from extensions import db, get_redis
+from geo_utils import nearby_pairs
+from models import Location
+
+# Location pings are appended to a Redis stream instead of being processed in the request.
+# The last accepted position per user is kept next to the stream, and a ping closer than
+# PING_MIN_DISTANCE to it is dropped, so a user standing still costs one GET. A periodic
+# task reads the stream through a consumer group and resolves every ping of a batch with
+# one set-based radius query.
+
+LAST_KEY = 'ping:last:{}'
+STREAM_KEY = 'pings'
+GROUP = 'ping-workers'
+
+_RECORD_SCRIPT = """
+local lat = tonumber(ARGV[1])
+local lng = tonumber(ARGV[2])
+local last = redis.call('GET', KEYS[1])
+if last then
+    local sep = string.find(last, ',')
+    local lat0 = math.rad(tonumber(string.sub(last, 1, sep - 1)))
+    local lng0 = math.rad(tonumber(string.sub(last, sep + 1)))
+    local a = math.sin((math.rad(lat) - lat0) / 2) ^ 2
+        + math.cos(lat0) * math.cos(math.rad(lat)) * math.sin((math.rad(lng) - lng0) / 2) ^ 2
+    if 2 * 6371008.8 * math.asin(math.sqrt(a)) < tonumber(ARGV[3]) then
+        return 0
+    end
+end
+redis.call('SET', KEYS[1], ARGV[1] .. ',' .. ARGV[2], 'EX', ARGV[4])
+redis.call('XADD', KEYS[2], 'MAXLEN', '~', ARGV[5], '*', 'user_id', ARGV[6], 'lat', ARGV[1], 'lng', ARGV[2])
+return 1
+"""
+
+
+def enabled():
+    return current_app.config['PING_INGESTION_ENABLED'] and get_redis() is not None
+
+
+def record(user_id, lat, lng):
+    """Queue a ping; False when it moved less than PING_MIN_DISTANCE from the last one.
+
+    Returns None when Redis fails, so the caller can process the ping inline instead.
+    """
+    config = current_app.config
+    try:
+        return bool(get_redis().eval(
+            _RECORD_SCRIPT, 2, LAST_KEY.format(user_id), STREAM_KEY,
+            repr(float(lat)), repr(float(lng)), config['PING_MIN_DISTANCE'],
+            config['PING_LAST_POSITION_TTL'], config['PING_STREAM_MAXLEN'], user_id
+        ))
+    except redis.RedisError as e:
+        current_app.logger.warning(f"Ping ingestion unavailable, processing inline: {e}")
+        return None
+
+
+def _read_batch(client, consumer, count):
+    # Entries a dead consumer left unacknowledged are taken over before new ones are read
+    _, claimed, *_ = client.xautoclaim(STREAM_KEY, GROUP, consumer, min_idle_time=60000, count=count)
+    if claimed:
+        return claimed
+    streams = client.xreadgroup(GROUP, consumer, {STREAM_KEY: '>'}, count=count)
+    return streams[0][1] if streams else []
+
+
+def _locations_without_image(entries):
+    points = {
+        (round(float(fields[b'lat']), 5), round(float(fields[b'lng']), 5))
+        for _, fields in entries
+    }
+    radius = current_app.config['PING_RADIUS']
+    ids = {location_id for _, location_id in nearby_pairs([(lat, lng, radius) for lat, lng in points])}
+    if not ids:
+        return []
+    return [row.id for row in db.session.query(Location.id).filter(
+        Location.id.in_(ids), Location.image_status != 'ready'
+    )]
+
+
+def drain(dispatch):
+    """Process queued pings in batches; `dispatch` receives each location id needing an image."""
+    client = get_redis()
+    if client is None:
+        return 0
+    config = current_app.config
+    # One consumer per worker process; several prefork children share a hostname
+    consumer = f'{socket.gethostname()}:{os.getpid()}'
+    try:
+        client.xgroup_create(STREAM_KEY, GROUP, id='0', mkstream=True)
+    except redis.ResponseError as e:
+        if 'BUSYGROUP' not in str(e):
+            raise
+
+    processed = 0
+    for _ in range(config['PING_DRAIN_MAX_BATCHES']):
+        entries = _read_batch(client, consumer, config['PING_DRAIN_BATCH_SIZE'])
+        if not entries:
+            break
+        for location_id in _locations_without_image(entries):
+            dispatch(location_id)
+        entry_ids = [entry_id for entry_id, _ in entries]
+        client.xack(STREAM_KEY, GROUP, *entry_ids)
+        client.xdel(STREAM_KEY, *entry_ids)
+        processed += len(entries)
+    return processed
@@ -0,0 +1,65 @@
+import threading
+import time
+from flask import current_app
+import redis
+from extensions import get_redis
+
+# Token buckets shared by every worker process through Redis, so the provider limits in
+# RATE_LIMITS hold however many threads or processes are generating at once. Without
+# Redis each process falls back to its own in-memory bucket.
+
+_TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or capacity
+local ts = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + (now - ts) * rate / 1000)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = math.ceil((1 - tokens) * 1000 / rate)
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil(capacity * 1000 / rate) + 1000)
+return wait
+"""
+
+_local_buckets = {}
+_local_lock = threading.Lock()
+
+
+def _take_local(name, rate, capacity):
+    with _local_lock:
+        tokens, ts = _local_buckets.get(name, (capacity, time.monotonic()))
+        now = time.monotonic()
+        tokens = min(capacity, tokens + (now - ts) * rate)
+        if tokens >= 1:
+            _local_buckets[name] = (tokens - 1, now)
+            return 0
+        _local_buckets[name] = (tokens, now)
+        return (1 - tokens) / rate
+
+
+def _take(name, rate, capacity):
+    """Take a token if one is available, otherwise return the seconds to wait."""
+    client = get_redis()
+    if client is not None:
+        try:
+            wait_ms = client.eval(_TOKEN_BUCKET_SCRIPT, 1, f'rate_limit:{name}', rate, capacity)
+            return wait_ms / 1000
+        except redis.RedisError as e:
+            current_app.logger.warning(f"Rate limiter unavailable, using local bucket: {e}")
+    return _take_local(name, rate, capacity)
+
+
+def acquire(name):
+    """Block until a call to the named provider is allowed."""
+    rate, capacity = current_app.config['RATE_LIMITS'][name]
+    wait = _take(name, rate, capacity)
+    while wait > 0:
+        time.sleep(wait)
+        wait = _take(name, rate, capacity)
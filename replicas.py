@@ -0,0 +1,88 @@
+import random
+from contextlib import contextmanager
+from functools import wraps
+from flask import current_app, g, has_request_context
+from flask_jwt_extended import get_jwt_identity
+from sqlalchemy import event
+import redis
+from extensions import RoutingSession, get_redis
+
+# Read-only endpoints run their queries on a replica bind (SQLALCHEMY_BINDS 'replica_*').
+# After a user commits anything, their reads stay on the primary for
+# REPLICA_READ_YOUR_WRITES_SECONDS so they never see a replica that is behind their own
+# write. That marker lives in Redis; without Redis, authenticated reads use the primary.
+
+MARKER_KEY = 'replica:recent_write:{}'
+
+
+def _user_id():
+    try:
+        return get_jwt_identity()
+    except RuntimeError:
+        # No JWT was verified for this request
+        return None
+
+
+def _recently_wrote(user_id):
+    client = get_redis()
+    if client is None:
+        return True
+    try:
+        return bool(client.exists(MARKER_KEY.format(user_id)))
+    except redis.RedisError as e:
+        current_app.logger.warning(f"Read-your-writes check failed, using primary: {e}")
+        return True
+
+
+def choose_replica():
+    """Bind key of the replica for this request, or None to stay on the primary."""
+    replicas = current_app.config['REPLICA_BINDS']
+    if not replicas:
+        return None
+    user_id = _user_id()
+    if user_id is not None and _recently_wrote(user_id):
+        return None
+    return random.choice(replicas)
+
+
+def read_only(f):
+    """Route the endpoint's queries to a replica; put it below @jwt_required()."""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        g.db_replica = choose_replica()
+        return f(*args, **kwargs)
+    return decorated_function
+
+
+@contextmanager
+def primary():
+    """Run the enclosed queries on the primary inside a @read_only request.
+
+    For results that outlive the request (response caches, ETags tied to the version
+    counters): a lagging replica could otherwise pin data older than the current version.
+    """
+    replica = g.get('db_replica')
+    g.db_replica = None
+    try:
+        yield
+    finally:
+        g.db_replica = replica
+
+
+def answered_by_replica():
+    """True once a query of this request ran on a replica; its result must not get an ETag."""
+    return g.get('db_replica_used', False)
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def _mark_recent_write(session):
+    if not has_request_context() or g.get('db_replica') is not None:
+        return
+    user_id = _user_id()
+    client = get_redis()
+    if user_id is None or client is None or not current_app.config['REPLICA_BINDS']:
+        return
+    try:
+        client.set(MARKER_KEY.format(user_id), 1, ex=current_app.config['REPLICA_READ_YOUR_WRITES_SECONDS'])
+    except redis.RedisError as e:
+        current_app.logger.warning(f"Read-your-writes marker failed: {e}")
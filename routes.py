@@ -1,17 +1,44 @@
-from flask import Blueprint, request, jsonify
-from flask_jwt_extended import jwt_required, get_jwt_identity, create_access_token
+from flask import Blueprint, Response, request, jsonify, current_app, g, stream_with_context
+from flask_jwt_extended import jwt_required, get_jwt, get_jwt_identity, create_access_token
 from functools import wraps
 from extensions import db
-from models import User, Location, ContextSnippet, LocationMedia, user_favorites
-from geoalchemy2.functions import ST_DWithin
+from models import User, Location, ContextSnippet, LocationMedia, user_favorites, location_geography
+from geoalchemy2 import Geography
 from geoalchemy2.shape import from_shape
 from shapely.geometry import Point
+from geo_utils import within_metres, nearby_pairs, nearest_first, distance_metres
+from sqlalchemy import text, cast, func, or_
+from sqlalchemy.orm import selectinload
+from sqlalchemy.dialects.postgresql import insert
+from replicate.webhook import Webhooks, WebhookSigningSecret
+from urllib.parse import urlparse, parse_qs
+from image_leases import hold_image_lease_after_failure
+import base64
+import hashlib
+import io
+import json
+import math
 import os
+import context_cache
+import image_cache
+import identity_cache
+import pings
+import spatial_index
+import tile_cache
+import versions
+from hashing import HashingBusy
+from replicas import read_only, primary, answered_by_replica
+from bulk_import import import_locations
 
 
 bp = Blueprint('main', __name__)
 
 
+@bp.errorhandler(HashingBusy)
+def hashing_busy(e):
+    return jsonify({'error': 'Server busy, try again shortly'}), 503, {'Retry-After': '1'}
+
+
 @bp.route('/')
 def home():
     """
@@ -29,19 +56,91 @@ def home():
         "status": "running",
         "docs": "https://github.com/Theocrite2/Explora",
         "endpoints": {
-            "public": ["GET /api/context?lat=&lng=&radius="],
+            "public": ["GET /api/context?lat=&lng=&radius=", "GET /api/nearest?lat=&lng=&k=&type=",
+                       "POST /api/context/batch",
+                       "POST /api/route/corridor", "GET /tiles/<z>/<x>/<y>.mvt",
+                       "GET /api/viewport?west=&south=&east=&north=&zoom="],
             "auth": ["POST /api/register", "POST /api/login"],
             "user": ["GET /api/favorites", "POST /api/locations/<id>/favorite",
                      "DELETE /api/locations/<id>/favorite", "POST /api/user/location",
                      "GET /api/locations/<id>"],
-            "admin": ["POST /api/admin/locations", "GET /admin/users",
+            "admin": ["POST /api/admin/locations", "POST /api/admin/locations/bulk",
+                      "GET /api/admin/cache/stats",
+                      "GET /api/admin/image-cache", "DELETE /api/admin/image-cache", "GET /admin/users",
                       "GET /admin/users/<id>", "PATCH /admin/users/<id>",
-                      "DELETE /admin/users/<id>"]
+                      "DELETE /admin/users/<id>"],
+            "webhooks": ["POST /api/webhooks/replicate"]
         }
     })
 
 
+def serialize_location(loc):
+    return {
+        'name': loc.name,
+        'coordinates': {'lat': loc.latitude, 'lng': loc.longitude},
+        'snippets': [{
+            'title': snippet.title,
+            'description': snippet.description,
+            'type': snippet.type,
+            'source': snippet.source_url
+        } for snippet in loc.snippets],
+        'media': [{
+            'type': m.media_type,
+            'url': m.url
+        } for m in loc.media]
+    }
+
+
+def locations_within_query(lat, lng, radius):
+    # Snippets and media are batch-loaded so the request costs 3 queries, not 1 + 2N
+    query = Location.query.options(
+        selectinload(Location.snippets),
+        selectinload(Location.media)
+    )
+    ids = spatial_index.ids_within(lat, lng, radius)
+    if ids is None:
+        return query.filter(within_metres(lat, lng, radius))
+    return query.filter(Location.id.in_(ids)) if ids else None
+
+
+def locations_within(lat, lng, radius):
+    query = locations_within_query(lat, lng, radius)
+    return query.all() if query is not None else []
+
+
+def _stream_json_array(query):
+    # Rows come off a server-side cursor in batches, each batch's snippets and media are
+    # selectin-loaded, and every element is written out before the next batch is read.
+    yield '['
+    if query is not None:
+        separator = ''
+        for loc in query.execution_options(stream_results=True).yield_per(200):
+            yield separator + json.dumps(serialize_location(loc))
+            separator = ','
+    yield ']'
+
+
+def _version_etag(version_name, *params):
+    # Strong ETag from a Redis change counter plus the request parameters; None without Redis
+    return _etag_at(version_name, versions.current(version_name), *params)
+
+
+def _etag_at(version_name, version, *params):
+    # Cached responses are tagged with the version their entry was built at, not the current one
+    if version is None:
+        return None
+    digest = hashlib.sha1(repr(params).encode()).hexdigest()[:16]
+    return f"{version_name.split(':')[0]}-{version}-{digest}"
+
+
+def _not_modified(etag):
+    response = Response(status=304)
+    response.set_etag(etag)
+    return response
+
+
 @bp.route('/api/context')
+@read_only
 def get_context():
     """
     Get nearby locations with context snippets and media
@@ -65,57 +164,532 @@ def get_context():
         required: false
         default: 1000
         description: Search radius in metres (default 1000)
+      - name: If-None-Match
+        in: header
+        type: string
+        required: false
+        description: ETag from a previous response; answered with 304 if nothing changed
+      - name: stream
+        in: query
+        type: boolean
+        required: false
+        default: false
+        description: Stream the JSON array as it is read instead of building it in memory; bypasses the response cache
     responses:
       200:
         description: List of nearby locations with snippets and media
+      304:
+        description: Not modified since the ETag in If-None-Match
       400:
         description: Missing lat or lng query parameter
     """
     lat = request.args.get('lat', type=float)
     lng = request.args.get('lng', type=float)
-    radius = request.args.get('radius', default=1000, type=float)  # metres
+    radius = request.args.get('radius', default=1000.0, type=float)  # metres
 
     if lat is None or lng is None:
         return jsonify({'error': 'Provide lat and lng parameters'}), 400
 
-    user_point = from_shape(Point(lng, lat), srid=4326)
+    stream = request.args.get('stream', 'false').lower() in ('1', 'true', 'yes')
+    cell = None if stream else context_cache.cell_for(lat, lng, radius)
+    cached = context_cache.get(cell) if cell else None
+    # Read before the database so a write landing in between leaves the older version behind
+    version = cached['version'] if cached else versions.current('locations')
+    etag = _etag_at('locations', version, lat, lng, radius, stream)
+    if etag and request.if_none_match.contains(etag):
+        return _not_modified(etag)
 
-    locations = Location.query.filter(
-        ST_DWithin(
-            Location.coordinates,
-            user_point,
-            radius
+    response = _context_response(lat, lng, radius, stream, cell, cached, version)
+    # A streamed body is read from the replica after this returns
+    if etag and not answered_by_replica() and not (stream and g.get('db_replica') is not None):
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
+def _context_response(lat, lng, radius, stream, cell, cached, version):
+    if stream:
+        return Response(
+            stream_with_context(_stream_json_array(locations_within_query(lat, lng, radius))),
+            mimetype='application/json'
         )
-    ).all()
-
-    if not locations:
-        return jsonify([])
-
-    result = []
-    for loc in locations:
-        loc_data = {
-            'name': loc.name,
-            'coordinates': {'lat': loc.latitude, 'lng': loc.longitude},
-            'snippets': [],
-            'media': []
-        }
-        for snippet in loc.snippets:
-            loc_data['snippets'].append({
-                'title': snippet.title,
-                'description': snippet.description,
-                'type': snippet.type,
-                'source': snippet.source_url
-            })
-        for m in loc.media:
-            loc_data['media'].append({
-                'type': m.media_type,
-                'url': m.url
-            })
-        result.append(loc_data)
 
+    if cached is not None:
+        return jsonify(context_cache.within(cached['locations'], lat, lng, radius))
+
+    if cell:
+        # The cache outlives the request, so fill it from the primary rather than a lagging replica
+        with primary():
+            result = [serialize_location(loc) for loc in locations_within(cell.lat, cell.lng, cell.radius)]
+        context_cache.put(cell, version, result)
+        return jsonify(context_cache.within(result, lat, lng, radius))
+
+    result = [serialize_location(loc) for loc in locations_within(lat, lng, radius)]
     return jsonify(result)
 
 
+@bp.route('/api/nearest')
+@read_only
+def get_nearest():
+    """
+    Get the K nearest locations, whatever their distance
+    ---
+    tags:
+      - Public
+    parameters:
+      - name: lat
+        in: query
+        type: number
+        required: true
+      - name: lng
+        in: query
+        type: number
+        required: true
+      - name: k
+        in: query
+        type: integer
+        required: false
+        default: 10
+        description: Number of locations to return, at most NEAREST_MAX_K
+      - name: type
+        in: query
+        type: string
+        required: false
+        description: Only locations with at least one snippet of this type
+      - name: If-None-Match
+        in: header
+        type: string
+        required: false
+        description: ETag from a previous response; answered with 304 if nothing changed
+    responses:
+      200:
+        description: Locations with snippets and media, nearest first, with `distance` in metres
+      304:
+        description: Not modified since the ETag in If-None-Match
+      400:
+        description: Missing lat or lng, or k out of range
+    """
+    lat = request.args.get('lat', type=float)
+    lng = request.args.get('lng', type=float)
+    k = request.args.get('k', default=10, type=int)
+    snippet_type = request.args.get('type')
+    max_k = current_app.config['NEAREST_MAX_K']
+
+    if lat is None or lng is None:
+        return jsonify({'error': 'Provide lat and lng parameters'}), 400
+    if not 1 <= k <= max_k:
+        return jsonify({'error': f'k must be between 1 and {max_k}'}), 400
+
+    etag = _version_etag('locations', 'nearest', lat, lng, k, snippet_type)
+    if etag and request.if_none_match.contains(etag):
+        return _not_modified(etag)
+
+    query = db.session.query(Location, distance_metres(lat, lng).label('distance')).options(
+        selectinload(Location.snippets),
+        selectinload(Location.media)
+    )
+    if snippet_type:
+        query = query.filter(Location.snippets.any(ContextSnippet.type == snippet_type))
+    rows = query.order_by(nearest_first(lat, lng)).limit(k).all()
+
+    response = jsonify([
+        dict(serialize_location(loc), id=loc.id, distance=distance) for loc, distance in rows
+    ])
+    if etag and not answered_by_replica():
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
+@bp.route('/api/context/batch', methods=['POST'])
+@read_only
+def get_context_batch():
+    """
+    Get nearby locations for many points in one request
+    ---
+    tags:
+      - Public
+    parameters:
+      - in: body
+        name: body
+        required: true
+        schema:
+          type: object
+          required:
+            - points
+          properties:
+            points:
+              type: array
+              description: >
+                Up to BATCH_CONTEXT_MAX_POINTS points; radius in metres defaults to 1000
+                and may be at most BATCH_CONTEXT_MAX_RADIUS
+              items:
+                type: object
+                properties:
+                  lat:
+                    type: number
+                    example: 48.8584
+                  lng:
+                    type: number
+                    example: 2.2945
+                  radius:
+                    type: number
+                    example: 500
+    responses:
+      200:
+        description: >
+          `results` lists the location ids near each point, in request order; `locations`
+          maps each id to the location with its snippets and media, serialized once
+      400:
+        description: Missing or invalid points, coordinates out of range, or radius out of range
+    """
+    data = request.get_json(silent=True) or {}
+    raw_points = data.get('points')
+    max_points = current_app.config['BATCH_CONTEXT_MAX_POINTS']
+    if not isinstance(raw_points, list) or not raw_points:
+        return jsonify({'error': 'Provide a non-empty points array'}), 400
+    if len(raw_points) > max_points:
+        return jsonify({'error': f'At most {max_points} points per request'}), 400
+
+    points = []
+    for point in raw_points:
+        try:
+            points.append((float(point['lat']), float(point['lng']), float(point.get('radius', 1000))))
+        except (KeyError, TypeError, ValueError):
+            return jsonify({'error': 'Each point needs numeric lat and lng'}), 400
+    # Range checks also reject NaN and infinities
+    if not all(-90 <= lat <= 90 and -180 <= lng <= 180 for lat, lng, _ in points):
+        return jsonify({'error': 'Point coordinates out of range'}), 400
+    max_radius = current_app.config['BATCH_CONTEXT_MAX_RADIUS']
+    if not all(0 < radius <= max_radius for _, _, radius in points):
+        return jsonify({'error': f'radius must be greater than 0 and at most {max_radius:g} metres'}), 400
+
+    ids_per_point = [[] for _ in points]
+    for idx, location_id in nearby_pairs(points):
+        ids_per_point[idx].append(location_id)
+
+    unique_ids = {location_id for ids in ids_per_point for location_id in ids}
+    locations = Location.query.options(
+        selectinload(Location.snippets),
+        selectinload(Location.media)
+    ).filter(Location.id.in_(unique_ids)).all() if unique_ids else []
+
+    return jsonify({
+        'results': [
+            {'lat': lat, 'lng': lng, 'radius': radius, 'location_ids': sorted(ids)}
+            for (lat, lng, radius), ids in zip(points, ids_per_point)
+        ],
+        'locations': {str(loc.id): serialize_location(loc) for loc in locations}
+    })
+
+
+def _corridor_sections(path):
+    """Split the route into runs of vertices with their [start, end) fraction along the line.
+
+    Fractions are planar, matching ST_LineLocatePoint on the 4326 geometry.
+    """
+    lengths = [math.dist(a, b) for a, b in zip(path, path[1:])]
+    total = sum(lengths) or 1.0
+    size = current_app.config['CORRIDOR_SECTION_VERTICES']
+    sections, travelled = [], 0.0
+    for start in range(0, len(path) - 1, size):
+        stop = min(start + size, len(path) - 1)
+        section_length = sum(lengths[start:stop])
+        sections.append((path[start:stop + 1], travelled / total, (travelled + section_length) / total))
+        travelled += section_length
+    return sections
+
+
+def _linestring(path):
+    return 'LINESTRING(' + ', '.join(f'{lng!r} {lat!r}' for lng, lat in path) + ')'
+
+
+@bp.route('/api/route/corridor', methods=['POST'])
+@read_only
+def route_corridor():
+    """
+    Stream locations within a distance of a route, in order along the route
+    ---
+    tags:
+      - Public
+    produces:
+      - application/x-ndjson
+    parameters:
+      - in: body
+        name: body
+        required: true
+        schema:
+          type: object
+          required:
+            - path
+          properties:
+            path:
+              type: array
+              description: Route vertices in travel order (at least 2)
+              items:
+                type: object
+                properties:
+                  lat:
+                    type: number
+                  lng:
+                    type: number
+            distance:
+              type: number
+              default: 100
+              description: Corridor half-width in metres
+    responses:
+      200:
+        description: >
+          NDJSON, one location per line with id, name, coordinates, fraction (0-1 position
+          along the route) and distance (metres from the route), ordered by fraction
+      400:
+        description: Invalid path or distance
+    """
+    data = request.get_json(silent=True) or {}
+    raw_path = data.get('path')
+    max_vertices = current_app.config['CORRIDOR_MAX_VERTICES']
+    if not isinstance(raw_path, list) or not 2 <= len(raw_path) <= max_vertices:
+        return jsonify({'error': f'path needs between 2 and {max_vertices} points'}), 400
+    try:
+        path = [(float(p['lng']), float(p['lat'])) for p in raw_path]
+        distance = float(data.get('distance', 100))
+    except (KeyError, TypeError, ValueError):
+        return jsonify({'error': 'Each path point needs numeric lat and lng'}), 400
+    # Range checks also reject NaN, which would otherwise fail inside the stream
+    if not all(-90 <= lat <= 90 and -180 <= lng <= 180 for lng, lat in path):
+        return jsonify({'error': 'Path coordinates out of range'}), 400
+    if not 0 < distance <= current_app.config['CORRIDOR_MAX_DISTANCE']:
+        return jsonify({'error': 'distance out of range'}), 400
+
+    route = func.ST_GeomFromText(_linestring(path), 4326)
+    fraction = func.ST_LineLocatePoint(route, Location.coordinates)
+    sections = _corridor_sections(path)
+
+    def generate():
+        # Each section is its own index-assisted ST_DWithin probe, read through a server-side
+        # cursor. A location is emitted by the section that holds its closest point on the
+        # route, so sections never overlap and the stream stays ordered by fraction.
+        for i, (section_path, start, end) in enumerate(sections):
+            section = cast(func.ST_GeomFromText(_linestring(section_path), 4326), Geography(srid=4326))
+            in_range = fraction >= start
+            if i < len(sections) - 1:
+                in_range = db.and_(in_range, fraction < end)
+            rows = db.session.query(
+                Location.id, Location.name, Location.latitude, Location.longitude,
+                fraction.label('fraction'),
+                func.ST_Distance(location_geography, cast(route, Geography(srid=4326))).label('distance')
+            ).filter(
+                func.ST_DWithin(location_geography, section, distance),
+                in_range
+            ).order_by('fraction', Location.id).execution_options(stream_results=True).yield_per(500)
+            for row in rows:
+                yield json.dumps({
+                    'id': row.id,
+                    'name': row.name,
+                    'coordinates': {'lat': row.latitude, 'lng': row.longitude},
+                    'fraction': row.fraction,
+                    'distance': row.distance
+                }) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+
+LOCATION_TILE = text("""
+    WITH bounds AS (
+        SELECT ST_TileEnvelope(:z, :x, :y) AS tile,
+               ST_Transform(ST_TileEnvelope(:z, :x, :y, margin => :margin), 4326) AS search
+    )
+    SELECT ST_AsMVT(features, 'locations', :extent, 'geom')
+    FROM (
+        SELECT location.id, location.name,
+               ST_AsMVTGeom(ST_Transform(location.coordinates, 3857), bounds.tile,
+                            :extent, :buffer, true) AS geom
+        FROM location, bounds
+        WHERE location.coordinates && bounds.search
+    ) AS features
+""")
+
+
+@bp.route('/tiles/<int:z>/<int:x>/<int:y>.mvt')
+def location_tile(z, x, y):
+    """
+    Get a Mapbox Vector Tile of locations for the map view
+    ---
+    tags:
+      - Public
+    produces:
+      - application/vnd.mapbox-vector-tile
+    parameters:
+      - name: z
+        in: path
+        type: integer
+        required: true
+      - name: x
+        in: path
+        type: integer
+        required: true
+      - name: y
+        in: path
+        type: integer
+        required: true
+      - name: If-None-Match
+        in: header
+        type: string
+        required: false
+        description: ETag from a previous response; answered with 304 if nothing changed
+    responses:
+      200:
+        description: Tile with a "locations" layer of points carrying id and name
+      304:
+        description: Not modified since the ETag in If-None-Match
+      404:
+        description: Tile outside the zoom range or the tile grid
+    """
+    config = current_app.config
+    if z > config['TILE_MAX_ZOOM'] or x >= 1 << z or y >= 1 << z:
+        return jsonify({'error': 'Tile not found'}), 404
+
+    cached = tile_cache.get(z, x, y)
+    version, tile = cached if cached else (versions.current('locations'), None)
+    etag = _etag_at('locations', version, 'tile', z, x, y)
+    if etag and request.if_none_match.contains(etag):
+        return _not_modified(etag)
+
+    if tile is None:
+        tile = db.session.execute(LOCATION_TILE, {
+            'z': z, 'x': x, 'y': y,
+            'extent': config['TILE_EXTENT'],
+            'buffer': config['TILE_BUFFER'],
+            'margin': config['TILE_BUFFER'] / config['TILE_EXTENT']
+        }).scalar()
+        tile = bytes(tile or b'')
+        tile_cache.put(z, x, y, version, tile)
+
+    response = Response(tile, mimetype='application/vnd.mapbox-vector-tile')
+    if etag:
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
+WEB_MERCATOR_WORLD_M = 40075016.68557849
+WEB_MERCATOR_MAX_LAT = 85.0511
+
+
+def _viewport_clusters(bbox, zoom, limit):
+    # Grid cells are VIEWPORT_CLUSTER_PIXELS wide on screen, so the cluster count is bounded
+    # by the viewport's pixel area however dense the data is
+    size = WEB_MERCATOR_WORLD_M / (256 * 2 ** zoom) * current_app.config['VIEWPORT_CLUSTER_PIXELS']
+    projected = func.ST_Transform(Location.coordinates, 3857)
+    cells = db.session.query(
+        func.count().label('count'),
+        func.min(Location.id).label('id'),
+        func.ST_Transform(func.ST_Centroid(func.ST_Collect(projected)), 4326).label('centroid')
+    ).filter(bbox).group_by(func.ST_SnapToGrid(projected, size)).subquery()
+    rows = db.session.query(
+        cells.c.count, cells.c.id, func.ST_Y(cells.c.centroid), func.ST_X(cells.c.centroid)
+    ).order_by(cells.c.count.desc()).limit(limit + 1).all()
+    return [
+        {'id': location_id, 'count': count, 'lat': lat, 'lng': lng}
+        for count, location_id, lat, lng in rows
+    ]
+
+
+@bp.route('/api/viewport')
+@read_only
+def get_viewport():
+    """
+    Get locations in a map viewport, clustered when zoomed out
+    ---
+    tags:
+      - Public
+    parameters:
+      - name: west
+        in: query
+        type: number
+        required: true
+      - name: south
+        in: query
+        type: number
+        required: true
+      - name: east
+        in: query
+        type: number
+        required: true
+        description: May be less than west for a viewport crossing the antimeridian
+      - name: north
+        in: query
+        type: number
+        required: true
+      - name: zoom
+        in: query
+        type: integer
+        required: true
+        description: Web map zoom level of the viewport
+      - name: If-None-Match
+        in: header
+        type: string
+        required: false
+        description: ETag from a previous response; answered with 304 if nothing changed
+    responses:
+      200:
+        description: >
+          Below VIEWPORT_CLUSTER_MAX_ZOOM, or when the viewport holds more than
+          VIEWPORT_MAX_ITEMS locations, `items` are grid clusters with `count`, centroid
+          `lat`/`lng` and a representative location `id`; otherwise they are single locations
+          with `id`, `name`, `lat` and `lng`. `truncated` is set when only the largest
+          VIEWPORT_MAX_ITEMS clusters were returned.
+      304:
+        description: Not modified since the ETag in If-None-Match
+      400:
+        description: Missing or invalid bbox or zoom
+    """
+    try:
+        west, south, east, north = (float(request.args[k]) for k in ('west', 'south', 'east', 'north'))
+        zoom = int(request.args['zoom'])
+    except (KeyError, ValueError):
+        return jsonify({'error': 'Provide numeric west, south, east, north and zoom parameters'}), 400
+    if not (-180 <= west <= 180 and -180 <= east <= 180 and -90 <= south < north <= 90
+            and 0 <= zoom <= 24):
+        return jsonify({'error': 'Invalid bbox or zoom'}), 400
+
+    etag = _version_etag('locations', 'viewport', west, south, east, north, zoom)
+    if etag and request.if_none_match.contains(etag):
+        return _not_modified(etag)
+
+    config = current_app.config
+    limit = config['VIEWPORT_MAX_ITEMS']
+    south, north = max(south, -WEB_MERCATOR_MAX_LAT), min(north, WEB_MERCATOR_MAX_LAT)
+    spans = [(west, east)] if west <= east else [(west, 180.0), (-180.0, east)]
+    bbox = or_(*[
+        Location.coordinates.op('&&')(func.ST_MakeEnvelope(w, south, e, north, 4326))
+        for w, e in spans
+    ])
+
+    items = None
+    if zoom >= config['VIEWPORT_CLUSTER_MAX_ZOOM']:
+        rows = db.session.query(
+            Location.id, Location.name, Location.latitude, Location.longitude
+        ).filter(bbox).order_by(Location.id).limit(limit + 1).all()
+        if len(rows) <= limit:
+            items = [{'id': row.id, 'name': row.name, 'lat': row.latitude, 'lng': row.longitude}
+                     for row in rows]
+    clustered = items is None
+    if clustered:
+        items = _viewport_clusters(bbox, zoom, limit)
+
+    response = jsonify({
+        'zoom': zoom,
+        'clustered': clustered,
+        'truncated': len(items) > limit,
+        'items': items[:limit]
+    })
+    if etag and not answered_by_replica():
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
 @bp.route('/api/register', methods=['POST'])
 def register():
     """
@@ -148,6 +722,8 @@ def register():
         description: User created successfully
       400:
         description: Missing fields, duplicate username, or duplicate email
+      503:
+        description: Password hashing pool saturated, retry shortly
     """
     data = request.get_json()
     if not data or not data.get('username') or not data.get('email') or not data.get('password'):
@@ -196,6 +772,8 @@ def login():
         description: Missing email or password
       401:
         description: Invalid email or password
+      503:
+        description: Password hashing pool saturated, retry shortly
     """
     data = request.get_json()
     if not data or not data.get('email') or not data.get('password'):
@@ -205,7 +783,12 @@ def login():
     if not user or not user.check_password(data['password']):
         return jsonify({'error': 'Invalid email or password'}), 401
 
-    access_token = create_access_token(identity=str(user.id))
+    # Move the hash to the current BCRYPT_LOG_ROUNDS while we have the plaintext
+    if user.password_needs_rehash():
+        user.set_password(data['password'])
+        db.session.commit()
+
+    access_token = create_access_token(identity=str(user.id), additional_claims={'is_admin': bool(user.is_admin)})
     return jsonify({'access_token': access_token, 'user_id': user.id, 'is_admin': user.is_admin}), 200
 
 
@@ -228,21 +811,27 @@ def add_favorite(location_id):
     responses:
       200:
         description: Location added to favorites (or already favorited)
+      401:
+        description: The token's user no longer exists
       404:
         description: Location not found
     """
     user_id = int(get_jwt_identity())
-    user = User.query.get(user_id)
-    location = Location.query.get(location_id)
-
-    if not location:
+    if not identity_cache.get_identity(user_id):
+        return jsonify({'error': 'User not found'}), 401
+    if not db.session.query(Location.id).filter_by(id=location_id).first():
         return jsonify({'error': 'Location not found'}), 404
 
-    if location in user.favorites:
-        return jsonify({'message': 'Already favorited'}), 200
-
-    user.favorites.append(location)
+    added = db.session.execute(
+        insert(user_favorites)
+        .values(user_id=user_id, location_id=location_id)
+        .on_conflict_do_nothing()
+    ).rowcount
     db.session.commit()
+
+    if not added:
+        return jsonify({'message': 'Already favorited'}), 200
+    versions.bump(f'favorites:{user_id}')
     return jsonify({'message': 'Location added to favorites'}), 200
 
 
@@ -267,17 +856,21 @@ def remove_favorite(location_id):
         description: Removed from favorites
     """
     user_id = int(get_jwt_identity())
-    user = User.query.get(user_id)
-    location = Location.query.get(location_id)
-
-    if location in user.favorites:
-        user.favorites.remove(location)
-        db.session.commit()
+    removed = db.session.execute(
+        user_favorites.delete().where(
+            user_favorites.c.user_id == user_id,
+            user_favorites.c.location_id == location_id
+        )
+    ).rowcount
+    db.session.commit()
+    if removed:
+        versions.bump(f'favorites:{user_id}')
     return jsonify({'message': 'Removed from favorites'}), 200
 
 
 @bp.route('/api/favorites', methods=['GET'])
 @jwt_required()
+@read_only
 def get_favorites():
     """
     Get the current user's favorited locations
@@ -286,30 +879,67 @@ def get_favorites():
       - User
     security:
       - BearerAuth: []
+    parameters:
+      - name: limit
+        in: query
+        type: integer
+        default: 50
+        description: Page size (max 200)
+      - name: cursor
+        in: query
+        type: integer
+        required: false
+        description: Value of X-Next-Cursor from the previous page
     responses:
       200:
-        description: List of favorited locations with id, name, latitude, and longitude
+        description: >
+          Page of favorited locations with id, name, latitude, and longitude, ordered by id.
+          The X-Next-Cursor header is set when more favorites follow.
+      304:
+        description: Not modified since the ETag in If-None-Match
     """
     user_id = int(get_jwt_identity())
-    user = User.query.get(user_id)
+    limit = min(max(request.args.get('limit', 50, type=int), 1), 200)
+    cursor = request.args.get('cursor', 0, type=int)
+
+    etag = _version_etag(f'favorites:{user_id}', user_id, limit, cursor)
+    if etag and request.if_none_match.contains(etag):
+        return _not_modified(etag)
+
+    # Keyset page straight off the (user_id, location_id) primary key
+    rows = db.session.query(
+        Location.id, Location.name, Location.latitude, Location.longitude
+    ).join(
+        user_favorites, user_favorites.c.location_id == Location.id
+    ).filter(
+        user_favorites.c.user_id == user_id,
+        user_favorites.c.location_id > cursor
+    ).order_by(user_favorites.c.location_id).limit(limit + 1).all()
 
-    favorites = []
-    for loc in user.favorites:
-        favorites.append({
-            'id': loc.id,
-            'name': loc.name,
-            'latitude': loc.latitude,
-            'longitude': loc.longitude
-        })
-    return jsonify(favorites), 200
+    favorites = [{
+        'id': row.id,
+        'name': row.name,
+        'latitude': row.latitude,
+        'longitude': row.longitude
+    } for row in rows[:limit]]
+
+    response = jsonify(favorites)
+    if len(rows) > limit:
+        response.headers['X-Next-Cursor'] = str(favorites[-1]['id'])
+    if etag and not answered_by_replica():
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'private, no-cache'
+    return response, 200
 
 
 def admin_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        user_id = get_jwt_identity()
-        user = User.query.get(user_id)
-        if not user or not user.is_admin:
+        # The token carries the role; the cached identity catches demotions and deletions
+        if not get_jwt().get('is_admin'):
+            return jsonify({'error': 'Admin access required'}), 403
+        identity = identity_cache.get_identity(int(get_jwt_identity()))
+        if not identity or not identity['is_admin']:
             return jsonify({'error': 'Admin access required'}), 403
         return f(*args, **kwargs)
     return decorated_function
@@ -355,7 +985,7 @@ def create_location():
         description: Admin access required
     """
     if not os.getenv('TESTING'):
-        from tasks import generate_location_image
+        from tasks import dispatch_image_generation
     data = request.get_json()
     if not data or not data.get('name') or not data.get('latitude') or not data.get('longitude'):
         return jsonify({'error': 'Missing name, latitude or longitude'}), 400
@@ -371,15 +1001,155 @@ def create_location():
     )
     db.session.add(location)
     db.session.commit()
+    # Invalidate before the bump: a request between the two must not tag old entries as new
+    context_cache.invalidate_location(lat, lng)
+    tile_cache.invalidate_location(lat, lng)
+    versions.bump('locations')
 
-    generate_location_image.delay(location.id)
+    if not os.getenv('TESTING'):
+        dispatch_image_generation(location.id)
 
     return jsonify({'id': location.id, 'message': 'Location created'}), 201
 
 
+@bp.route('/api/admin/locations/bulk', methods=['POST'])
+@jwt_required()
+@admin_required
+def bulk_create_locations():
+    """
+    Bulk import locations with optional snippets (admin only)
+    ---
+    tags:
+      - Admin
+    security:
+      - BearerAuth: []
+    consumes:
+      - application/x-ndjson
+      - text/csv
+    parameters:
+      - in: body
+        name: body
+        required: true
+        description: >
+          NDJSON, one {"name", "latitude", "longitude", "snippets": [...]} object per line,
+          or CSV with name,latitude,longitude and optional snippet_title, snippet_description,
+          snippet_type, snippet_source_url columns
+        schema:
+          type: string
+      - name: format
+        in: query
+        type: string
+        enum: [ndjson, csv]
+        required: false
+        description: Input format; defaults to csv for text/csv requests and ndjson otherwise
+      - name: batch_size
+        in: query
+        type: integer
+        required: false
+        description: Rows per INSERT batch
+    responses:
+      200:
+        description: Load report with inserted and failed counts, per-row errors, and throughput
+      403:
+        description: Admin access required
+    """
+    enqueue = None
+    if not os.getenv('TESTING'):
+        from tasks import dispatch_image_batch
+        enqueue = dispatch_image_batch.delay
+
+    fmt = request.args.get('format') or ('csv' if request.mimetype == 'text/csv' else 'ndjson')
+    lines = io.TextIOWrapper(io.BufferedReader(request.stream), encoding='utf-8', newline='')
+    report = import_locations(lines, fmt=fmt, batch_size=request.args.get('batch_size', type=int),
+                              enqueue=enqueue)
+    return jsonify(report), 200
+
+
+@bp.route('/api/admin/cache/stats', methods=['GET'])
+@jwt_required()
+@admin_required
+def context_cache_stats():
+    """
+    Get /api/context response cache statistics (admin only)
+    ---
+    tags:
+      - Admin
+    security:
+      - BearerAuth: []
+    responses:
+      200:
+        description: Hit and miss counters, hit rate, and the cell/radius-bucket configuration
+      403:
+        description: Admin access required
+    """
+    return jsonify(context_cache.stats()), 200
+
+
+@bp.route('/api/admin/image-cache', methods=['GET'])
+@jwt_required()
+@admin_required
+@read_only
+def image_cache_stats():
+    """
+    Get generated-image cache statistics (admin only)
+    ---
+    tags:
+      - Admin
+    security:
+      - BearerAuth: []
+    responses:
+      200:
+        description: Cached image count, total reuses, and hit/miss counters with hit rate
+      403:
+        description: Admin access required
+    """
+    return jsonify(image_cache.stats()), 200
+
+
+@bp.route('/api/admin/image-cache', methods=['DELETE'])
+@jwt_required()
+@admin_required
+def purge_image_cache():
+    """
+    Purge the generated-image cache (admin only)
+    ---
+    tags:
+      - Admin
+    security:
+      - BearerAuth: []
+    responses:
+      200:
+        description: Number of cache entries removed; already-assigned location images are kept
+      403:
+        description: Admin access required
+    """
+    deleted = image_cache.purge()
+    return jsonify({'message': f'Purged {deleted} cached images'}), 200
+
+
+def _encode_cursor(last_id):
+    return base64.urlsafe_b64encode(json.dumps({'id': last_id}).encode()).decode().rstrip('=')
+
+
+def _decode_cursor(cursor):
+    raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+    return int(json.loads(raw)['id'])
+
+
+def _serialize_user_row(user):
+    return {
+        'id': user.id,
+        'username': user.username,
+        'email': user.email,
+        'is_admin': user.is_admin,
+        'created_at': getattr(user, 'created_at', None)
+    }
+
+
 @bp.route('/admin/users', methods=['GET'])
 @jwt_required()
 @admin_required
+@read_only
 def list_users():
     """
     List all users with pagination (admin only)
@@ -393,40 +1163,103 @@ def list_users():
         in: query
         type: integer
         default: 1
-        description: Page number
+        description: Page number (offset mode)
       - name: per_page
         in: query
         type: integer
         default: 10
         description: Results per page
+      - name: cursor
+        in: query
+        type: string
+        required: false
+        description: >
+          Switches to keyset mode. Pass an empty value for the first page, then the
+          `next` value of the previous response
+      - name: count
+        in: query
+        type: string
+        enum: [exact, estimate, none]
+        default: exact
+        description: >
+          How to compute `total`; `estimate` reads pg_class.reltuples when no filter is
+          applied, `none` skips counting
+      - name: is_admin
+        in: query
+        type: boolean
+        required: false
+        description: Only admins (true) or only non-admins (false)
+      - name: q
+        in: query
+        type: string
+        required: false
+        description: Username or email prefix
     responses:
       200:
-        description: Paginated list of users with total, pages, and navigation flags
+        description: >
+          Page of users with total; offset mode adds page, pages and navigation flags,
+          keyset mode adds an opaque `next` cursor (null on the last page)
+      400:
+        description: Invalid cursor
       403:
         description: Admin access required
     """
-    page = request.args.get('page', 1, type=int)
-    per_page = request.args.get('per_page', 10, type=int)
-    pagination = User.query.order_by(User.id.desc()).paginate(page=page, per_page=per_page, error_out=False)
+    per_page = min(max(request.args.get('per_page', 10, type=int), 1), 100)
+    count_mode = request.args.get('count', 'exact')
 
-    users = []
-    for user in pagination.items:
-        users.append({
-            'id': user.id,
-            'username': user.username,
-            'email': user.email,
-            'is_admin': user.is_admin,
-            'created_at': getattr(user, 'created_at', None)
-        })
+    query = User.query
+    filtered = False
+    if request.args.get('is_admin') is not None:
+        is_admin = request.args.get('is_admin').lower() in ('1', 'true', 'yes')
+        # Admins are matched by the ix_user_admin_id partial index
+        query = query.filter(User.is_admin if is_admin else User.is_admin.isnot(True))
+        filtered = True
+    prefix = request.args.get('q')
+    if prefix:
+        # Served by the text_pattern_ops indexes on username and email
+        pattern = prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+        query = query.filter(db.or_(User.username.like(pattern), User.email.like(pattern)))
+        filtered = True
 
+    total, total_is_estimate = None, False
+    if count_mode == 'estimate' and not filtered:
+        total = db.session.execute(
+            text("SELECT reltuples::bigint FROM pg_class WHERE oid = to_regclass('public.\"user\"')")
+        ).scalar()
+        # reltuples is -1 until the table has been analyzed
+        total_is_estimate = total is not None and total >= 0
+    if count_mode != 'none' and not total_is_estimate:
+        total = query.order_by(None).count()
+
+    if 'cursor' in request.args:
+        cursor = request.args.get('cursor')
+        if cursor:
+            try:
+                query = query.filter(User.id < _decode_cursor(cursor))
+            except (ValueError, KeyError, TypeError):
+                return jsonify({'error': 'Invalid cursor'}), 400
+        rows = query.order_by(User.id.desc()).limit(per_page + 1).all()
+        users = [_serialize_user_row(user) for user in rows[:per_page]]
+        return jsonify({
+            'users': users,
+            'total': total,
+            'total_is_estimate': total_is_estimate,
+            'per_page': per_page,
+            'next': _encode_cursor(users[-1]['id']) if len(rows) > per_page else None
+        }), 200
+
+    page = max(request.args.get('page', 1, type=int), 1)
+    items = query.order_by(User.id.desc()).offset((page - 1) * per_page).limit(per_page + 1).all()
+    pages = math.ceil(total / per_page) if total is not None else None
     return jsonify({
-        'users': users,
-        'total': pagination.total,
+        'users': [_serialize_user_row(user) for user in items[:per_page]],
+        'total': total,
+        'total_is_estimate': total_is_estimate,
         'page': page,
         'per_page': per_page,
-        'pages': pagination.pages,
-        'has_next': pagination.has_next,
-        'has_prev': pagination.has_prev
+        'pages': pages,
+        'has_next': len(items) > per_page,
+        'has_prev': page > 1
     }), 200
 
 
@@ -467,6 +1300,7 @@ def delete_user(user_id):
 
     db.session.delete(user)
     db.session.commit()
+    identity_cache.invalidate(user_id)
     return jsonify({'message': f'User {user.username} deleted'}), 200
 
 
@@ -517,12 +1351,14 @@ def update_user(user_id):
         user.is_admin = bool(data['is_admin'])
 
     db.session.commit()
+    identity_cache.invalidate(user_id)
     return jsonify({'id': user.id, 'username': user.username, 'email': user.email, 'is_admin': user.is_admin}), 200
 
 
 @bp.route('/admin/users/<int:user_id>', methods=['GET'])
 @jwt_required()
 @admin_required
+@read_only
 def get_user(user_id):
     """
     Get a single user by ID (admin only)
@@ -581,30 +1417,100 @@ def update_location():
     responses:
       200:
         description: Location processed; returns nearby location count and any image generation tasks triggered
+      202:
+        description: >
+          Ping ingestion mode (PING_INGESTION_ENABLED); the ping was queued for batch processing,
+          or dropped (`accepted: false`) because it moved less than PING_MIN_DISTANCE metres
       400:
         description: Missing lat or lng
     """
-    from tasks import generate_location_image
+    from tasks import dispatch_image_generation
     data = request.get_json()
     lat = data.get('lat')
     lng = data.get('lng')
     if lat is None or lng is None:
         return jsonify({'msg': 'Missing lat/lng'}), 400
 
+    accepted = pings.record(int(get_jwt_identity()), lat, lng) if pings.enabled() else None
+    if accepted is not None:
+        return jsonify({'msg': 'Location queued' if accepted else 'Location unchanged',
+                        'accepted': accepted}), 202
+
     radius = 500
-    user_point = from_shape(Point(lng, lat), srid=4326)
-    nearby_locations = Location.query.filter(
-        ST_DWithin(Location.coordinates, user_point, radius)
-    ).all()
+    nearby_locations = Location.query.filter(within_metres(lat, lng, radius)).all()
 
     triggered = []
     for loc in nearby_locations:
-        if not any(m.media_type == 'image' for m in loc.media):
-            generate_location_image.delay(loc.id)
+        if loc.image_status != 'ready' and dispatch_image_generation(loc.id):
             triggered.append({'id': loc.id, 'name': loc.name})
 
     return jsonify({
         'msg': 'Location processed',
         'nearby_locations': len(nearby_locations),
         'generation_triggered_for': triggered
-    })
\ No newline at end of file
+    })
+
+
+@bp.route('/api/webhooks/replicate', methods=['POST'])
+def replicate_webhook():
+    """
+    Receive a completed Replicate prediction and queue the image upload
+    ---
+    tags:
+      - Webhooks
+    parameters:
+      - in: body
+        name: body
+        required: true
+        description: Replicate prediction object, signed with the webhook-id, webhook-timestamp and webhook-signature headers
+        schema:
+          type: object
+    responses:
+      200:
+        description: Upload queued, or the failed prediction acknowledged
+      400:
+        description: Prediction carries no location_id or no output
+      401:
+        description: Missing or invalid webhook signature
+      403:
+        description: Webhook signing secret not configured
+    """
+    secret = current_app.config['REPLICATE_WEBHOOK_SECRET']
+    if not secret:
+        return jsonify({'error': 'Webhook secret not configured'}), 403
+
+    body = request.get_data(as_text=True)
+    try:
+        Webhooks.validate(headers=dict(request.headers), body=body,
+                          secret=WebhookSigningSecret(key=secret), tolerance=300)
+    except ValueError:
+        return jsonify({'error': 'Invalid webhook signature'}), 401
+
+    # The location travels in the webhook URL, which is part of the signed body
+    prediction = json.loads(body)
+    location_id = parse_qs(urlparse(prediction.get('webhook') or '').query).get('location_id', [''])[0]
+    if not location_id.isdigit():
+        return jsonify({'error': 'Missing location_id'}), 400
+    location_id = int(location_id)
+
+    if prediction.get('status') != 'succeeded':
+        Location.set_image_status(location_id, 'failed')
+        db.session.commit()
+        hold_image_lease_after_failure(location_id)
+        return jsonify({'message': f"Prediction {prediction.get('status')}"}), 200
+
+    output = prediction.get('output')
+    image_url = output[0] if isinstance(output, list) and output else output
+    if not image_url:
+        Location.set_image_status(location_id, 'failed')
+        db.session.commit()
+        hold_image_lease_after_failure(location_id)
+        return jsonify({'error': 'Prediction has no output'}), 400
+
+    # Replicate retries deliveries it did not see acknowledged; the image may already be stored
+    if db.session.query(Location.image_status).filter_by(id=location_id).scalar() == 'ready':
+        return jsonify({'message': 'Image already stored'}), 200
+
+    from tasks import store_location_image
+    store_location_image.delay(location_id, image_url)
+    return jsonify({'message': 'Image upload queued'}), 200
@@ -0,0 +1,158 @@
+import math
+import threading
+import time
+import numpy as np
+from flask import current_app
+from sqlalchemy import func, select
+from extensions import db
+from models import Location
+import versions
+
+# Optional in-process read path for radius queries. Location ids and coordinates live in
+# numpy columns sorted by grid cell, so a query is a handful of searchsorted() slices plus a
+# vectorized haversine over the candidates. PostGIS stays the source of truth: the index
+# picks up new rows (id > last loaded id) when the 'locations' version counter moves, is
+# rebuilt in full every SPATIAL_INDEX_REBUILD_SECONDS, and get_context falls back to
+# PostGIS whenever it is disabled or not loaded yet. Ids are allocated before commit (bulk
+# imports reserve whole ranges), so a row can commit below the last loaded id; a refresh
+# therefore also counts the rows up to that id and rebuilds when the count disagrees.
+# Locations are never updated in place or deleted, which is what makes the count enough.
+
+EARTH_RADIUS_M = 6371008.8
+METRES_PER_DEGREE = 111320.0
+# Cell columns per row in the packed cell key; covers longitudes at any cell size >= 0.001°
+_ROW_STRIDE = 1 << 20
+
+
+class GridIndex:
+    def __init__(self, ids, lats, lngs, cell_degrees):
+        self.cell_degrees = cell_degrees
+        keys = self._keys(lats, lngs)
+        order = np.argsort(keys, kind='stable')
+        self.keys = keys[order]
+        self.ids = np.asarray(ids, dtype=np.int64)[order]
+        self.lats = np.asarray(lats, dtype=np.float64)[order]
+        self.lngs = np.asarray(lngs, dtype=np.float64)[order]
+        self.max_id = int(self.ids.max()) if len(self.ids) else 0
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _keys(self, lats, lngs):
+        rows = np.floor(np.asarray(lats, dtype=np.float64) / self.cell_degrees).astype(np.int64)
+        cols = np.floor(np.asarray(lngs, dtype=np.float64) / self.cell_degrees).astype(np.int64)
+        return rows * _ROW_STRIDE + cols
+
+    def extended(self, ids, lats, lngs):
+        return GridIndex(
+            np.concatenate([self.ids, ids]),
+            np.concatenate([self.lats, lats]),
+            np.concatenate([self.lngs, lngs]),
+            self.cell_degrees
+        )
+
+    def _column_ranges(self, lng, dlng):
+        if dlng >= 180:
+            return [(-180.0, 180.0)]
+        lo, hi = lng - dlng, lng + dlng
+        ranges = [(max(lo, -180.0), min(hi, 180.0))]
+        if lo < -180:
+            ranges.append((lo + 360, 180.0))
+        if hi > 180:
+            ranges.append((-180.0, hi - 360))
+        return ranges
+
+    def ids_within(self, lat, lng, radius):
+        size = self.cell_degrees
+        dlat = radius / METRES_PER_DEGREE
+        dlng = dlat / max(math.cos(math.radians(min(abs(lat) + dlat, 90.0))), 1e-6)
+
+        slices = []
+        for row in range(math.floor((lat - dlat) / size), math.floor((lat + dlat) / size) + 1):
+            for lo, hi in self._column_ranges(lng, dlng):
+                start = np.searchsorted(self.keys, row * _ROW_STRIDE + math.floor(lo / size), 'left')
+                stop = np.searchsorted(self.keys, row * _ROW_STRIDE + math.floor(hi / size), 'right')
+                if stop > start:
+                    slices.append(np.arange(start, stop))
+        if not slices:
+            return []
+        candidates = np.concatenate(slices)
+
+        lat1, lng1 = math.radians(lat), math.radians(lng)
+        lat2, lng2 = np.radians(self.lats[candidates]), np.radians(self.lngs[candidates])
+        a = (np.sin((lat2 - lat1) / 2) ** 2
+             + math.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2)
+        distances = 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(a))
+        return self.ids[candidates[distances <= radius]].tolist()
+
+
+_index = None
+_version = None
+_checked_at = 0.0
+_built_at = 0.0
+_refresh_lock = threading.Lock()
+
+
+def _load(after_id=0):
+    # Always read from the primary: rows a lagging replica misses would stay missing
+    # until the next full rebuild
+    rows = db.session.execute(
+        select(Location.id, Location.latitude, Location.longitude).where(
+            Location.id > after_id
+        ).order_by(Location.id).execution_options(yield_per=50000),
+        bind_arguments={'bind': db.engine}
+    )
+    ids, lats, lngs = [], [], []
+    for row in rows:
+        ids.append(row.id)
+        lats.append(row.latitude)
+        lngs.append(row.longitude)
+    return np.array(ids, dtype=np.int64), np.array(lats, dtype=np.float64), np.array(lngs, dtype=np.float64)
+
+
+def _count_upto(max_id):
+    return db.session.execute(
+        select(func.count()).select_from(Location).where(Location.id <= max_id),
+        bind_arguments={'bind': db.engine}
+    ).scalar()
+
+
+def refresh(force=False):
+    """Bring the index up to date; cheap when the 'locations' version has not moved."""
+    global _index, _version, _checked_at, _built_at
+    now = time.monotonic()
+    config = current_app.config
+    if not force and _index is not None and now - _checked_at < config['SPATIAL_INDEX_CHECK_SECONDS']:
+        return
+    if not _refresh_lock.acquire(blocking=_index is None):
+        return
+    try:
+        _checked_at = now
+        version = versions.current('locations')
+        rebuild = force or _index is None or now - _built_at >= config['SPATIAL_INDEX_REBUILD_SECONDS']
+        changed = version is None or version != _version
+        if not rebuild and changed and _count_upto(_index.max_id) != len(_index):
+            # A row committed late, below ids that were already loaded
+            rebuild = True
+        if rebuild:
+            _index = GridIndex(*_load(), cell_degrees=config['SPATIAL_INDEX_CELL_DEGREES'])
+            _built_at = now
+        elif changed:
+            ids, lats, lngs = _load(after_id=_index.max_id)
+            if len(ids):
+                _index = _index.extended(ids, lats, lngs)
+        _version = version
+    finally:
+        _refresh_lock.release()
+
+
+def ids_within(lat, lng, radius):
+    """Location ids within `radius` metres, or None when PostGIS should answer instead."""
+    if not current_app.config['SPATIAL_INDEX_ENABLED']:
+        return None
+    try:
+        refresh()
+    except Exception as e:
+        current_app.logger.warning(f"Spatial index refresh failed: {e}")
+    index = _index
+    return index.ids_within(lat, lng, radius) if index is not None else None
@@ -1,64 +1,202 @@
-import os
 import replicate
 import requests
-import tempfile
+from requests.adapters import HTTPAdapter
+from celery.exceptions import Retry
+from flask import current_app
 from app import celery
 from extensions import db
 from models import Location, LocationMedia
-from cloudinary_utils import upload_image
+from cloudinary_utils import upload_image, upload_stream
+from image_leases import acquire_image_lease, hold_image_lease_after_failure, release_image_lease
+import context_cache
+import image_cache
+import metrics
+import pings
+import rate_limit
+import uuid
+import versions
+
+IMAGE_MODEL = "black-forest-labs/flux-1.1-pro"
+
+_http_session = None
+
+
+def http_session():
+    """Keep-alive HTTP session shared by every task in this worker process."""
+    global _http_session
+    if _http_session is None:
+        _http_session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=32)
+        _http_session.mount('https://', adapter)
+        _http_session.mount('http://', adapter)
+    return _http_session
+
+
+def build_prompt(name):
+    return (
+        f"Generate an image representing {name} "
+        "with a twist of grandeur, fantasy, historical, "
+        "kind of first person view."
+    )
+
+
+def dispatch_image_generation(location_id):
+    """Enqueue image generation unless one is already pending or running for the location."""
+    if not acquire_image_lease(location_id):
+        return False
+    generate_location_image.delay(location_id)
+    return True
+
+
+@celery.task
+def dispatch_image_batch(location_ids):
+    """Fan a bulk import's new locations out to image generation, one message per chunk."""
+    return sum(dispatch_image_generation(location_id) for location_id in location_ids)
+
+
+@celery.task(ignore_result=True)
+def drain_location_pings():
+    """Resolve queued location pings in batches (scheduled by celery beat)."""
+    return pings.drain(dispatch_image_generation)
+
+
+def _run_holding_lease(location_id, step, *args):
+    # `step` returns (message, pending); the lease is kept while the task is waiting to be
+    # retried or while a Replicate prediction is still running.
+    try:
+        message, pending = step(*args)
+    except Retry:
+        raise
+    except Exception:
+        db.session.rollback()
+        Location.set_image_status(location_id, 'failed')
+        db.session.commit()
+        hold_image_lease_after_failure(location_id)
+        raise
+    if not pending:
+        release_image_lease(location_id)
+    return message
 
 
 @celery.task(bind=True, max_retries=3, default_retry_delay=10)
 def generate_location_image(self, location_id):
+    return _run_holding_lease(location_id, _generate_location_image, self, location_id)
+
+
+@celery.task(bind=True, max_retries=3, default_retry_delay=10)
+def store_location_image(self, location_id, image_url):
+    """Second phase of webhook mode: upload a finished prediction and record it."""
+    return _run_holding_lease(location_id, _store_location_image, self, location_id, image_url)
+
+
+def _generate_location_image(self, location_id):
     # 1. Fetch location
     location = Location.query.get(location_id)
     if not location:
-        return f"Location {location_id} not found"
+        return f"Location {location_id} not found", False
 
     # 2. Skip if image already exists
-    existing = LocationMedia.query.filter_by(
-        location_id=location_id,
-        media_type='image'
-    ).first()
-    if existing:
-        return f"Image already exists for location {location_id}"
-
-    # 3. Build prompt
-    prompt = (
-        f"Generate an image representing {location.name} "
-        "with a twist of grandeur, fantasy, historical, "
-        "kind of first person view."
-    )
+    if location.image_status == 'ready':
+        return f"Image already exists for location {location_id}", False
+    if location.image_status != 'pending':
+        Location.set_image_status(location_id, 'pending')
+        db.session.commit()
+
+    # 3. Build prompt, reusing any image already generated for the same model and prompt
+    prompt = build_prompt(location.name)
+    cached_url = image_cache.lookup(image_cache.prompt_key(IMAGE_MODEL, prompt))
+    if cached_url:
+        _save_location_image(location, cached_url)
+        return f"Reused cached image for location {location_id}: {cached_url}", False
+
+    # Hand the DB connection back to the pool while we wait on Replicate
+    db.session.close()
 
-    # 4. Call Replicate
+    # 4a. Webhook mode: start the prediction and free the worker slot right away
+    rate_limit.acquire('replicate')
+    webhook_url = current_app.config['REPLICATE_WEBHOOK_URL']
+    if webhook_url:
+        try:
+            with metrics.timed_call('replicate', 'predictions.create'):
+                prediction = replicate.predictions.create(
+                    model=IMAGE_MODEL,
+                    input={"prompt": prompt},
+                    webhook=f"{webhook_url}?location_id={location_id}",
+                    webhook_events_filter=["completed"]
+                )
+        except Exception as e:
+            raise self.retry(exc=e)
+        return f"Prediction {prediction.id} started for location {location_id}", True
+
+    # 4b. Call Replicate and wait for the output
     try:
-        output = replicate.run(
-            "black-forest-labs/flux-1.1-pro",
-            input={"prompt": prompt}
-        )
+        with metrics.timed_call('replicate', 'run'):
+            output = replicate.run(
+                IMAGE_MODEL,
+                input={"prompt": prompt}
+            )
         image_url = output[0] if isinstance(output, list) else str(output)
     except Exception as e:
         raise self.retry(exc=e)
 
-    # 5. Download to temp file
-    with tempfile.NamedTemporaryFile(suffix=".png", delete=False) as tmp:
-        tmp.write(requests.get(image_url).content)
-        tmp_path = tmp.name
+    return _store_location_image(self, location_id, image_url, location)
+
 
-    # 6. Upload to Cloudinary
-    public_id = f"explora/location_{location_id}"
+def _store_location_image(self, location_id, image_url, location=None):
+    location = location or Location.query.get(location_id)
+    if not location:
+        return f"Location {location_id} not found", False
+    # Replicate may deliver the same webhook more than once
+    if location.image_status == 'ready':
+        return f"Image already exists for location {location_id}", False
+
+    # 5. Stream from Replicate straight into a chunked Cloudinary upload
+    prompt = build_prompt(location.name)
+    key = image_cache.prompt_key(IMAGE_MODEL, prompt)
+    # Unique per upload: after an image cache purge the same prompt is generated again, and
+    # reusing its public_id would overwrite the asset that earlier locations still show
+    public_id = f"explora/img_{key[:32]}_{uuid.uuid4().hex[:8]}"
+    rate_limit.acquire('cloudinary')
     try:
-        cloudinary_url = upload_image(tmp_path, public_id=public_id)
-    finally:
-        os.unlink(tmp_path)
+        with http_session().get(
+            image_url,
+            stream=True,
+            timeout=current_app.config['IMAGE_DOWNLOAD_TIMEOUT'],
+            headers={'Accept-Encoding': 'identity'}
+        ) as response:
+            response.raise_for_status()
+            size = response.headers.get('Content-Length')
+            if size is None:
+                # 6. Unknown length: let Cloudinary fetch the URL itself
+                cloudinary_url = upload_image(image_url, public_id=public_id)
+            else:
+                # 6. Upload chunk by chunk as the body is read
+                cloudinary_url = upload_stream(response.raw, int(size), public_id=public_id)
+    except requests.RequestException as e:
+        raise self.retry(exc=e)
 
     # 7. Save to DB
+    image_cache.remember(key, IMAGE_MODEL, prompt, cloudinary_url)
+    if not _save_location_image(location, cloudinary_url):
+        return f"Image already exists for location {location_id}", False
+
+    return f"Image generated for location {location_id}: {cloudinary_url}", False
+
+
+def _save_location_image(location, url):
+    """Attach the image and mark the location ready; False if a concurrent task already did."""
+    status = db.session.query(Location.image_status).filter_by(id=location.id).with_for_update().scalar()
+    if status == 'ready':
+        db.session.commit()
+        return False
     media = LocationMedia(
-        location_id=location_id,
+        location_id=location.id,
         media_type='image',
-        url=cloudinary_url
+        url=url
     )
     db.session.add(media)
+    Location.set_image_status(location.id, 'ready')
     db.session.commit()
-
-    return f"Image generated for location {location_id}: {cloudinary_url}"
\ No newline at end of file
+    context_cache.invalidate_location(location.latitude, location.longitude)
+    versions.bump('locations')
+    return True
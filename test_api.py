@@ -1,17 +1,26 @@
+import base64
+import hashlib
+import hmac
+import json
 import os
+import time
+import uuid
 import pytest
+import redis
 from app import app as flask_app
 from extensions import db
-from models import Location, ContextSnippet
+from models import User, Location, ContextSnippet, LocationMedia
 from geoalchemy2.shape import from_shape
 from shapely.geometry import Point
-from sqlalchemy import text
+from sqlalchemy import text, event
+import versions
 
 
 @pytest.fixture
 def app():
     flask_app.config['TESTING'] = True
     flask_app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('TEST_DATABASE_URL')
+    flask_app.config['REDIS_URL'] = None
     with flask_app.app_context():
         db.create_all()
         yield flask_app
@@ -22,6 +31,104 @@ def client(app):
     return app.test_client()
 
 
+class FakeRedis:
+    """Just enough of redis.Redis, in memory, for the cache and version-counter paths."""
+
+    def __init__(self):
+        self.data = {}
+        self.delivered = set()
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def mget(self, *keys):
+        return [self.data.get(key) for key in keys]
+
+    def set(self, key, value, ex=None, nx=False):
+        if nx and key in self.data:
+            return None
+        self.data[key] = value if isinstance(value, bytes) else str(value).encode()
+        return True
+
+    def incr(self, key):
+        self.data[key] = str(int(self.data.get(key, 0)) + 1).encode()
+        return int(self.data[key])
+
+    def exists(self, *keys):
+        return sum(key in self.data for key in keys)
+
+    def unlink(self, *keys):
+        return sum(self.data.pop(key, None) is not None for key in keys)
+
+    delete = unlink
+
+    def scan_iter(self, match='*', count=None):
+        import fnmatch
+        return [key for key in list(self.data) if fnmatch.fnmatchcase(key, match)]
+
+    def pipeline(self, transaction=True):
+        return self
+
+    def execute(self):
+        return []
+
+    def flushall(self):
+        self.data.clear()
+
+    # Streams: a single consumer group, enough for pings.drain
+    def xadd(self, key, fields):
+        stream = self.data.setdefault(key, [])
+        entry_id = f'{len(stream) + 1}-0'.encode()
+        stream.append((entry_id, {k.encode(): str(v).encode() for k, v in fields.items()}))
+        return entry_id
+
+    def xgroup_create(self, key, group, id='0', mkstream=False):
+        self.data.setdefault(key, [])
+
+    def xautoclaim(self, key, group, consumer, min_idle_time=0, count=None):
+        return [b'0-0', [], []]
+
+    def xreadgroup(self, group, consumer, streams, count=None):
+        (key, _), = streams.items()
+        entries = [e for e in self.data.get(key, []) if e[0] not in self.delivered][:count]
+        self.delivered.update(entry_id for entry_id, _ in entries)
+        return [[key.encode(), entries]] if entries else []
+
+    def xack(self, key, group, *ids):
+        return len(ids)
+
+    def xdel(self, key, *ids):
+        self.data[key] = [e for e in self.data.get(key, []) if e[0] not in ids]
+        return len(ids)
+
+
+class BrokenRedis:
+    """A Redis client whose server is down: every command raises."""
+
+    def __getattr__(self, name):
+        def command(*args, **kwargs):
+            raise redis.ConnectionError('Redis is down')
+        return command
+
+
+@pytest.fixture
+def broken_redis(app):
+    from extensions import _redis_clients
+    _redis_clients['redis://down'] = BrokenRedis()
+    app.config['REDIS_URL'] = 'redis://down'
+    yield
+    app.config['REDIS_URL'] = None
+
+
+@pytest.fixture
+def fake_redis(app):
+    from extensions import _redis_clients
+    fake = _redis_clients['redis://fake'] = FakeRedis()
+    app.config['REDIS_URL'] = 'redis://fake'
+    yield fake
+    app.config['REDIS_URL'] = None
+
+
 def test_get_context_empty(client):
     response = client.get('/api/context?lat=0.0&lng=0.0')
     assert response.status_code == 200
@@ -62,4 +169,733 @@ def test_register(client):
     })
     assert response.status_code == 201
     data = response.get_json()
-    assert data['message'] == 'User created successfully'
\ No newline at end of file
+    assert data['message'] == 'User created successfully'
+
+def test_login_rehashes_password_below_configured_cost(client, app):
+    from models import bcrypt
+    with app.app_context():
+        user = User(username='low_cost', email='low_cost@example.com',
+                    password_hash=bcrypt.generate_password_hash('secret123', 4).decode('utf-8'))
+        db.session.add(user)
+        db.session.commit()
+
+    response = client.post('/api/login', json={'email': 'low_cost@example.com', 'password': 'secret123'})
+    assert response.status_code == 200
+    with app.app_context():
+        user = User.query.filter_by(email='low_cost@example.com').one()
+        assert not user.password_needs_rehash()
+        assert user.check_password('secret123')
+
+
+def test_hashing_pool_saturated_returns_503(client, monkeypatch):
+    import hashing
+
+    def busy(fn, *args):
+        raise hashing.HashingBusy()
+    monkeypatch.setattr(hashing, 'run', busy)
+    response = client.post('/api/register', json={
+        'username': 'busy_user', 'email': 'busy@example.com', 'password': 'secret123'
+    })
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '1'
+
+
+def test_get_context_radius_is_metres(client):
+    with flask_app.app_context():
+        test_loc = Location(
+            name='Radius Monument',
+            latitude=30.0,
+            longitude=40.0,
+            coordinates=from_shape(Point(40.0, 30.0), srid=4326)
+        )
+        db.session.add(test_loc)
+        db.session.commit()
+
+    # ~1.1 km north of the monument
+    response = client.get('/api/context?lat=30.01&lng=40.0&radius=1000')
+    assert response.status_code == 200
+    assert response.get_json() == []
+
+    response = client.get('/api/context?lat=30.01&lng=40.0&radius=2000')
+    assert [loc['name'] for loc in response.get_json()] == ['Radius Monument']
+
+
+def test_get_context_query_count_is_constant(client):
+    with flask_app.app_context():
+        for i in range(5):
+            lat, lng = -20.0 + i * 0.001, 50.0
+            loc = Location(
+                name=f'Batch Monument {i}',
+                latitude=lat,
+                longitude=lng,
+                coordinates=from_shape(Point(lng, lat), srid=4326)
+            )
+            db.session.add(loc)
+            db.session.add(ContextSnippet(title='History', type='history',
+                                          description='test description', location=loc))
+            db.session.add(LocationMedia(media_type='image', url='https://example.com/img.png',
+                                         location=loc))
+        db.session.commit()
+
+        statements = []
+
+        def count_statement(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', count_statement)
+        try:
+            response = client.get('/api/context?lat=-20.0&lng=50.0&radius=2000')
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', count_statement)
+
+    assert response.status_code == 200
+    data = response.get_json()
+    assert len(data) == 5
+    assert all(len(loc['snippets']) == 1 and len(loc['media']) == 1 for loc in data)
+    # locations + snippets + media, regardless of how many locations matched
+    assert len(statements) == 3
+
+
+WEBHOOK_SECRET = 'whsec_' + base64.b64encode(b'test-webhook-secret').decode()
+
+
+def signed_webhook_headers(body):
+    webhook_id, timestamp = 'msg_test', str(int(time.time()))
+    digest = hmac.new(b'test-webhook-secret', f'{webhook_id}.{timestamp}.{body}'.encode(), hashlib.sha256).digest()
+    return {
+        'webhook-id': webhook_id,
+        'webhook-timestamp': timestamp,
+        'webhook-signature': 'v1,' + base64.b64encode(digest).decode(),
+        'Content-Type': 'application/json'
+    }
+
+
+def test_replicate_webhook_rejects_unsigned(client, app):
+    app.config['REPLICATE_WEBHOOK_SECRET'] = WEBHOOK_SECRET
+    response = client.post('/api/webhooks/replicate', json={'status': 'succeeded'})
+    assert response.status_code == 401
+
+
+def test_replicate_webhook_acknowledges_failed_prediction(client, app):
+    app.config['REPLICATE_WEBHOOK_SECRET'] = WEBHOOK_SECRET
+    body = json.dumps({
+        'id': 'pred_1',
+        'status': 'failed',
+        'webhook': 'https://example.com/api/webhooks/replicate?location_id=1'
+    })
+    response = client.post('/api/webhooks/replicate', data=body, headers=signed_webhook_headers(body))
+    assert response.status_code == 200
+    assert response.get_json()['message'] == 'Prediction failed'
+
+
+def test_failed_prediction_holds_the_lease_for_a_cooldown(client, app, fake_redis):
+    from image_leases import acquire_image_lease, LEASE_KEY
+    app.config['REPLICATE_WEBHOOK_SECRET'] = WEBHOOK_SECRET
+    body = json.dumps({
+        'id': 'pred_3',
+        'status': 'failed',
+        'webhook': 'https://example.com/api/webhooks/replicate?location_id=424242'
+    })
+    response = client.post('/api/webhooks/replicate', data=body, headers=signed_webhook_headers(body))
+    assert response.status_code == 200
+    # A nearby ping must not start another paid prediction straight away
+    assert LEASE_KEY.format(424242) in fake_redis.data
+    assert not acquire_image_lease(424242)
+
+
+def test_replicate_webhook_redelivery_does_not_store_twice(client, app):
+    app.config['REPLICATE_WEBHOOK_SECRET'] = WEBHOOK_SECRET
+    with app.app_context():
+        location = Location(name='Webhook Twice', latitude=-20.0, longitude=30.0,
+                            coordinates=from_shape(Point(30.0, -20.0), srid=4326), image_status='ready')
+        db.session.add(location)
+        db.session.flush()
+        db.session.add(LocationMedia(location_id=location.id, media_type='image', url='https://img/1.png'))
+        db.session.commit()
+        location_id = location.id
+
+    body = json.dumps({
+        'id': 'pred_2',
+        'status': 'succeeded',
+        'output': ['https://replicate.delivery/out.png'],
+        'webhook': f'https://example.com/api/webhooks/replicate?location_id={location_id}'
+    })
+    for _ in range(2):
+        response = client.post('/api/webhooks/replicate', data=body, headers=signed_webhook_headers(body))
+        assert response.status_code == 200
+        assert response.get_json()['message'] == 'Image already stored'
+    assert LocationMedia.query.filter_by(location_id=location_id).count() == 1
+
+
+def test_bulk_import_reports_bad_rows(app):
+    from bulk_import import import_locations
+    lines = [
+        json.dumps({'name': 'Bulk One', 'latitude': 60.0, 'longitude': 70.0,
+                    'snippets': [{'title': 'T', 'description': 'D', 'type': 'history'}]}),
+        '{not json',
+        json.dumps({'name': 'Bulk Two', 'latitude': 95.0, 'longitude': 70.0}),
+        json.dumps({'name': 'Bulk Three', 'latitude': 60.001, 'longitude': 70.0}),
+        json.dumps({'name': 5, 'latitude': 60.0, 'longitude': 70.0}),
+        json.dumps({'name': 'Bulk Four', 'latitude': 60.0, 'longitude': 70.0, 'snippets': ['x']}),
+        json.dumps({'name': 'Bulk Five', 'latitude': 60.0, 'longitude': 70.0, 'snippets': {'title': 'T'}}),
+        json.dumps(['Bulk Six', 60.0, 70.0]),
+    ]
+    report = import_locations(lines, batch_size=2)
+
+    assert report['inserted'] == 2
+    assert report['failed'] == 6
+    assert [e['line'] for e in report['errors']] == [2, 3, 5, 6, 7, 8]
+    bulk_one = Location.query.filter_by(name='Bulk One').one()
+    assert [s.title for s in bulk_one.snippets] == ['T']
+    assert bulk_one.coordinates is not None
+
+
+def auth_headers(client):
+    name = f'user_{uuid.uuid4().hex[:12]}'
+    client.post('/api/register', json={'username': name, 'email': f'{name}@example.com', 'password': 'secret123'})
+    token = client.post('/api/login', json={'email': f'{name}@example.com', 'password': 'secret123'}).get_json()['access_token']
+    return {'Authorization': f'Bearer {token}'}
+
+
+def admin_headers(client):
+    name = f'admin_{uuid.uuid4().hex[:12]}'
+    with flask_app.app_context():
+        admin = User(username=name, email=f'{name}@example.com', is_admin=True)
+        admin.set_password('secret123')
+        db.session.add(admin)
+        db.session.commit()
+    token = client.post('/api/login', json={'email': f'{name}@example.com', 'password': 'secret123'}).get_json()['access_token']
+    return {'Authorization': f'Bearer {token}'}
+
+
+def test_favorites_are_idempotent_and_paginated(client):
+    headers = auth_headers(client)
+    with flask_app.app_context():
+        locations = [
+            Location(name=f'Favorite {i}', latitude=-40.0, longitude=10.0 + i,
+                     coordinates=from_shape(Point(10.0 + i, -40.0), srid=4326))
+            for i in range(3)
+        ]
+        db.session.add_all(locations)
+        db.session.commit()
+        ids = [loc.id for loc in locations]
+
+    for location_id in ids:
+        assert client.post(f'/api/locations/{location_id}/favorite', headers=headers).status_code == 200
+    response = client.post(f'/api/locations/{ids[0]}/favorite', headers=headers)
+    assert response.get_json()['message'] == 'Already favorited'
+
+    first = client.get('/api/favorites?limit=2', headers=headers)
+    assert [f['id'] for f in first.get_json()] == ids[:2]
+    cursor = first.headers['X-Next-Cursor']
+    second = client.get(f'/api/favorites?limit=2&cursor={cursor}', headers=headers)
+    assert [f['id'] for f in second.get_json()] == ids[2:]
+    assert 'X-Next-Cursor' not in second.headers
+
+    client.delete(f'/api/locations/{ids[1]}/favorite', headers=headers)
+    remaining = client.get('/api/favorites', headers=headers).get_json()
+    assert [f['id'] for f in remaining] == [ids[0], ids[2]]
+
+
+def test_demoted_admin_loses_access_with_old_token(client):
+    headers = admin_headers(client)
+    demoted = admin_headers(client)
+    # Caches the still-admin identity in this process
+    assert client.get('/admin/users?cursor=', headers=demoted).status_code == 200
+    with flask_app.app_context():
+        from flask_jwt_extended import decode_token
+        user_id = int(decode_token(demoted['Authorization'].split()[1])['sub'])
+
+    response = client.patch(f'/admin/users/{user_id}', headers=headers, json={'is_admin': False})
+    assert response.status_code == 200 and response.get_json()['is_admin'] is False
+    assert client.get('/admin/users?cursor=', headers=demoted).status_code == 403
+    assert client.get('/admin/users?cursor=', headers=auth_headers(client)).status_code == 403
+
+
+def test_identity_cache_is_bounded(app, monkeypatch):
+    import identity_cache
+    monkeypatch.setattr(identity_cache, '_local', identity_cache.OrderedDict())
+    monkeypatch.setitem(app.config, 'IDENTITY_CACHE_MAX_ENTRIES', 3)
+    for user_id in range(-10, 0):
+        assert identity_cache.get_identity(user_id) is None
+    assert list(identity_cache._local) == [-3, -2, -1]
+
+
+def test_list_users_keyset_pagination(client):
+    prefix = f'ks{uuid.uuid4().hex[:8]}'
+    with flask_app.app_context():
+        admin = User(username=f'{prefix}_admin', email=f'{prefix}_admin@example.com', is_admin=True)
+        admin.set_password('secret123')
+        db.session.add(admin)
+        for i in range(3):
+            user = User(username=f'{prefix}_{i}', email=f'{prefix}_{i}@example.com')
+            user.set_password('secret123')
+            db.session.add(user)
+        db.session.commit()
+    token = client.post('/api/login', json={'email': f'{prefix}_admin@example.com', 'password': 'secret123'}).get_json()['access_token']
+    headers = {'Authorization': f'Bearer {token}'}
+
+    seen = []
+    cursor = ''
+    while cursor is not None:
+        data = client.get(f'/admin/users?cursor={cursor}&per_page=2&q={prefix}_', headers=headers).get_json()
+        assert data['total'] == 4
+        seen.extend(u['username'] for u in data['users'])
+        cursor = data['next']
+    assert seen == [f'{prefix}_2', f'{prefix}_1', f'{prefix}_0', f'{prefix}_admin']
+
+    admins = client.get(f'/admin/users?cursor=&q={prefix}_&is_admin=true', headers=headers).get_json()
+    assert [u['username'] for u in admins['users']] == [f'{prefix}_admin']
+    assert client.get('/admin/users?cursor=not-a-cursor', headers=headers).status_code == 400
+
+
+def test_grid_index_matches_haversine_scan():
+    import numpy as np
+    from spatial_index import GridIndex
+    from geo_utils import haversine_metres
+
+    rng = np.random.default_rng(7)
+    ids = np.arange(1, 2001)
+    lats, lngs = rng.uniform(-60, 60, 2000), rng.uniform(-180, 180, 2000)
+    index = GridIndex(ids, lats, lngs, cell_degrees=0.5)
+
+    for lat, lng, radius in [(0.0, 179.9, 400000), (45.0, 10.0, 250000), (-30.0, -120.0, 1000)]:
+        expected = {int(i) for i, la, ln in zip(ids, lats, lngs) if haversine_metres(lat, lng, la, ln) <= radius}
+        assert set(index.ids_within(lat, lng, radius)) == expected
+
+
+def test_spatial_index_picks_up_rows_committed_below_loaded_ids(app, fake_redis, monkeypatch):
+    import spatial_index
+    monkeypatch.setattr(spatial_index, '_index', None)
+    monkeypatch.setitem(app.config, 'SPATIAL_INDEX_ENABLED', True)
+    monkeypatch.setitem(app.config, 'SPATIAL_INDEX_CHECK_SECONDS', 0)
+
+    def add(location_id, name):
+        db.session.add(Location(id=location_id, name=name, latitude=-45.0, longitude=170.0,
+                                coordinates=from_shape(Point(170.0, -45.0), srid=4326)))
+        db.session.commit()
+        versions.bump('locations')
+
+    with app.app_context():
+        # Ids are reserved up front, as bulk imports do, and the higher one commits first
+        low, high = db.session.execute(
+            text("SELECT nextval(pg_get_serial_sequence('location', 'id')) FROM generate_series(1, 2)")
+        ).scalars()
+        add(high, 'Index High')
+        assert high in spatial_index.ids_within(-45.0, 170.0, 100)
+        add(low, 'Index Low')
+        assert {low, high} <= set(spatial_index.ids_within(-45.0, 170.0, 100))
+
+
+def test_get_context_batch_deduplicates_locations(client):
+    with flask_app.app_context():
+        shared = Location(name='Shared Landmark', latitude=-50.0, longitude=-60.0,
+                          coordinates=from_shape(Point(-60.0, -50.0), srid=4326))
+        db.session.add(shared)
+        db.session.commit()
+        shared_id = shared.id
+
+    response = client.post('/api/context/batch', json={'points': [
+        {'lat': -50.001, 'lng': -60.0, 'radius': 500},
+        {'lat': -49.999, 'lng': -60.0, 'radius': 500},
+        {'lat': -55.0, 'lng': -60.0},
+    ]})
+    assert response.status_code == 200
+    data = response.get_json()
+    assert [r['location_ids'] for r in data['results']] == [[shared_id], [shared_id], []]
+    assert list(data['locations']) == [str(shared_id)]
+    assert data['locations'][str(shared_id)]['name'] == 'Shared Landmark'
+
+    assert client.post('/api/context/batch', json={'points': []}).status_code == 400
+    for bad in [{'lat': 'nan', 'lng': 0.0}, {'lat': 91.0, 'lng': 0.0}, {'lat': 0.0, 'lng': 'inf'},
+                {'lat': 0.0, 'lng': 0.0, 'radius': -1}, {'lat': 0.0, 'lng': 0.0, 'radius': 1e12},
+                {'lat': 0.0, 'lng': 0.0, 'radius': 'nan'}]:
+        assert client.post('/api/context/batch', json={'points': [bad]}).status_code == 400
+
+
+def test_route_corridor_streams_in_route_order(client):
+    with flask_app.app_context():
+        # Route runs east along latitude 70; "Far" is ~5.5 km off the route
+        for name, lat, lng in [('Corridor B', 70.0005, 1.02), ('Corridor A', 69.9995, 1.005),
+                               ('Corridor Far', 70.05, 1.01)]:
+            db.session.add(Location(name=name, latitude=lat, longitude=lng,
+                                    coordinates=from_shape(Point(lng, lat), srid=4326)))
+        db.session.commit()
+
+    path = [{'lat': 70.0, 'lng': 1.0 + i * 0.01} for i in range(4)]
+    response = client.post('/api/route/corridor', json={'path': path, 'distance': 200})
+    assert response.status_code == 200
+    assert response.mimetype == 'application/x-ndjson'
+    rows = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert [row['name'] for row in rows] == ['Corridor A', 'Corridor B']
+    assert rows[0]['fraction'] < rows[1]['fraction']
+    assert all(row['distance'] <= 200 for row in rows)
+
+    for bad_path, distance in [([{'lat': 'nan', 'lng': 1.0}, {'lat': 70.0, 'lng': 1.01}], 200),
+                               ([{'lat': 91.0, 'lng': 1.0}, {'lat': 70.0, 'lng': 1.01}], 200),
+                               ([{'lat': 70.0, 'lng': 'inf'}, {'lat': 70.0, 'lng': 1.01}], 200),
+                               (path, 'nan')]:
+        response = client.post('/api/route/corridor', json={'path': bad_path, 'distance': distance})
+        assert response.status_code == 400
+
+
+def test_get_context_stream_matches_buffered(client):
+    with flask_app.app_context():
+        for i, name in enumerate(['Stream North', 'Stream South']):
+            location = Location(name=name, latitude=36.0 + i * 0.002, longitude=-120.0,
+                                coordinates=from_shape(Point(-120.0, 36.0 + i * 0.002), srid=4326))
+            db.session.add(location)
+            db.session.add(ContextSnippet(title=f'{name} story', type='history',
+                                          description='streamed', location=location))
+        db.session.commit()
+
+    buffered = client.get('/api/context?lat=36.001&lng=-120.0&radius=2000').get_json()
+    streamed = client.get('/api/context?lat=36.001&lng=-120.0&radius=2000&stream=true')
+    assert streamed.status_code == 200
+    assert sorted(l['name'] for l in buffered) == ['Stream North', 'Stream South']
+    assert all(l['snippets'] for l in buffered)
+    assert sorted(json.loads(streamed.get_data(as_text=True)), key=lambda l: l['name']) == \
+        sorted(buffered, key=lambda l: l['name'])
+    assert json.loads(client.get('/api/context?lat=1.0&lng=-150.0&stream=1').get_data(as_text=True)) == []
+
+
+def test_location_tile(client):
+    import tile_cache
+    with flask_app.app_context():
+        db.session.add(Location(name='Tile Point', latitude=-33.857, longitude=151.215,
+                                coordinates=from_shape(Point(151.215, -33.857), srid=4326)))
+        db.session.commit()
+        (x, y), = tile_cache.tiles_for(-33.857, 151.215, 12)
+
+    response = client.get(f'/tiles/12/{x}/{y}.mvt')
+    assert response.status_code == 200
+    assert response.mimetype == 'application/vnd.mapbox-vector-tile'
+    assert b'Tile Point' in response.data
+    assert client.get(f'/tiles/12/{x}/{(y + 2) % 4096}.mvt').data == b''
+    assert client.get('/tiles/2/4/0.mvt').status_code == 404
+
+
+def test_viewport_clusters_when_zoomed_out(client):
+    with flask_app.app_context():
+        for i in range(5):
+            lat, lng = -60.0 + i * 0.001, -120.0 + i * 0.001
+            db.session.add(Location(name=f'Viewport {i}', latitude=lat, longitude=lng,
+                                    coordinates=from_shape(Point(lng, lat), srid=4326)))
+        db.session.commit()
+
+    bbox = 'west=-121&south=-61&east=-119&north=-59'
+    zoomed_out = client.get(f'/api/viewport?{bbox}&zoom=3').get_json()
+    assert zoomed_out['clustered'] is True
+    assert [item['count'] for item in zoomed_out['items']] == [5]
+
+    zoomed_in = client.get(f'/api/viewport?{bbox}&zoom=16').get_json()
+    assert zoomed_in['clustered'] is False
+    assert sorted(item['name'] for item in zoomed_in['items']) == [f'Viewport {i}' for i in range(5)]
+    assert client.get('/api/viewport?west=0&south=10&east=1&north=5&zoom=3').status_code == 400
+
+
+def test_nearest_orders_by_distance_and_filters_by_type(client):
+    with flask_app.app_context():
+        for name, lat, snippet_type in [('Near B', 40.002, 'history'), ('Near A', 40.001, 'nature'),
+                                        ('Near C', 40.5, 'history')]:
+            loc = Location(name=name, latitude=lat, longitude=-100.0,
+                           coordinates=from_shape(Point(-100.0, lat), srid=4326))
+            db.session.add(loc)
+            db.session.add(ContextSnippet(title=name, description='d', type=snippet_type, location=loc))
+        db.session.commit()
+
+    data = client.get('/api/nearest?lat=40.0&lng=-100.0&k=2').get_json()
+    assert [loc['name'] for loc in data] == ['Near A', 'Near B']
+    assert 100 < data[0]['distance'] < 120
+
+    data = client.get('/api/nearest?lat=40.0&lng=-100.0&k=2&type=history').get_json()
+    assert [loc['name'] for loc in data] == ['Near B', 'Near C']
+    assert client.get('/api/nearest?lat=40.0&lng=-100.0&k=0').status_code == 400
+
+
+def test_migrations_apply_cleanly_over_create_all(app):
+    import migrate
+    db.session.remove()
+    migrate.migrate(echo=lambda message: None)
+    assert migrate.migrate(echo=lambda message: None) == []
+    versions = [version for version, _, _ in migrate.available()]
+    assert versions == sorted(set(versions))
+
+
+@pytest.mark.skipif(not os.getenv('TEST_REPLICA_DATABASE_URLS'), reason='no replica configured')
+def test_read_only_requests_use_replica_unless_authenticated_without_redis(app):
+    from flask_jwt_extended import create_access_token
+    from replicas import read_only
+    bind = read_only(lambda: db.session.get_bind())
+
+    with app.test_request_context('/'):
+        assert bind() is db.engines['replica_0']
+        db.session.remove()
+
+    token = create_access_token(identity='1')
+    with app.test_request_context('/', headers={'Authorization': f'Bearer {token}'}):
+        from flask_jwt_extended import verify_jwt_in_request
+        verify_jwt_in_request()
+        # Without Redis there is no read-your-writes marker to consult, so stay on the primary
+        assert bind() is db.engine
+
+
+def test_metrics_exports_request_counts(client):
+    client.get('/api/context?lat=0.0&lng=0.0')
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    body = response.get_data(as_text=True)
+    assert 'http_requests_total{method="GET",endpoint="/api/context",status="200"}' in body
+    assert 'http_request_db_queries_count{endpoint="/api/context"}' in body
+
+
+def test_get_context_etag_answers_304_until_locations_change(client, fake_redis):
+    # Wider than every cache bucket, so the ETag follows the current version
+    url = '/api/context?lat=-40.0&lng=-70.0&radius=10000'
+    first = client.get(url)
+    assert first.status_code == 200 and first.headers.get('ETag')
+
+    again = client.get(url, headers={'If-None-Match': first.headers['ETag']})
+    assert again.status_code == 304
+
+    with flask_app.app_context():
+        versions.bump('locations')
+    changed = client.get(url, headers={'If-None-Match': first.headers['ETag']})
+    assert changed.status_code == 200
+    assert changed.headers['ETag'] != first.headers['ETag']
+
+
+def test_cached_context_and_tile_etags_change_when_a_location_is_added(client, fake_redis):
+    import tile_cache
+    headers = admin_headers(client)
+    with flask_app.app_context():
+        (x, y), = tile_cache.tiles_for(-41.0, -71.0, 12)
+    context_url, tile_url = '/api/context?lat=-41.0&lng=-71.0&radius=500', f'/tiles/12/{x}/{y}.mvt'
+
+    primed = {url: client.get(url).headers['ETag'] for url in (context_url, tile_url)}
+    for url, etag in primed.items():
+        assert client.get(url, headers={'If-None-Match': etag}).status_code == 304
+
+    response = client.post('/api/admin/locations', headers=headers,
+                           json={'name': 'Fresh Entry', 'latitude': -41.0, 'longitude': -71.0})
+    assert response.status_code == 201
+
+    for url, etag in primed.items():
+        changed = client.get(url, headers={'If-None-Match': etag})
+        assert changed.status_code == 200
+        assert changed.headers['ETag'] != etag
+    assert [loc['name'] for loc in client.get(context_url).get_json()] == ['Fresh Entry']
+    assert b'Fresh Entry' in client.get(tile_url).data
+
+
+def test_context_cache_hit_skips_database_and_writes_drop_only_nearby_cells(client, fake_redis):
+    import context_cache
+    headers = admin_headers(client)
+    with flask_app.app_context():
+        db.session.add(Location(name='Cached Spot', latitude=-42.0, longitude=-72.0,
+                                coordinates=from_shape(Point(-72.0, -42.0), srid=4326)))
+        db.session.commit()
+        near = context_cache.cell_for(-42.0, -72.0, 500).key
+        far = context_cache.cell_for(-42.5, -72.0, 500).key
+
+    url = '/api/context?lat=-42.0&lng=-72.0&radius=500'
+    first = client.get(url).get_json()
+    client.get('/api/context?lat=-42.5&lng=-72.0&radius=500')
+    assert near in fake_redis.data and far in fake_redis.data
+
+    statements = []
+
+    def count_statement(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    with flask_app.app_context():
+        event.listen(db.engine, 'before_cursor_execute', count_statement)
+        try:
+            second = client.get(url).get_json()
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', count_statement)
+    assert second == first and [loc['name'] for loc in second] == ['Cached Spot']
+    assert statements == []
+
+    client.post('/api/admin/locations', headers=headers,
+                json={'name': 'Cached Spot 2', 'latitude': -42.0005, 'longitude': -72.0})
+    assert near not in fake_redis.data
+    assert far in fake_redis.data
+
+
+def test_context_cache_stats_survive_redis_outage(client, app):
+    headers = admin_headers(client)
+    from extensions import _redis_clients
+    _redis_clients['redis://down'] = BrokenRedis()
+    app.config['REDIS_URL'] = 'redis://down'
+    try:
+        response = client.get('/api/admin/cache/stats', headers=headers)
+    finally:
+        app.config['REDIS_URL'] = None
+    assert response.status_code == 200
+    assert response.get_json()['enabled'] is True
+
+
+def test_version_etag_changes_after_redis_flush(client, fake_redis):
+    url = '/api/context?lat=-40.0&lng=-70.0&radius=500'
+    etag = client.get(url).headers['ETag']
+    fake_redis.flushall()
+    assert client.get(url, headers={'If-None-Match': etag}).status_code == 200
+
+
+def test_replica_reads_stay_out_of_caches_and_etags(client, app, fake_redis):
+    with app.app_context():
+        location = Location(name='Replica Lag', latitude=-33.0, longitude=151.0,
+                            coordinates=from_shape(Point(151.0, -33.0), srid=4326))
+        db.session.add(location)
+        db.session.commit()
+        location_id = location.id
+    headers = auth_headers(client)
+    assert client.post(f'/api/locations/{location_id}/favorite', headers=headers).status_code == 200
+
+    # A "replica" that is behind the primary: it has not seen the location or the favorite yet
+    replica = db.engine.connect()
+    stale = replica.begin()
+    replica.execute(text('DELETE FROM user_favorites WHERE location_id = :id'), {'id': location_id})
+    replica.execute(text('DELETE FROM location WHERE id = :id'), {'id': location_id})
+    db.engines['replica_stale'] = replica
+    replica_binds, app.config['REPLICA_BINDS'] = app.config['REPLICA_BINDS'], ['replica_stale']
+    try:
+        cached = client.get('/api/context?lat=-33.0&lng=151.0&radius=500')
+        assert [loc['name'] for loc in cached.get_json()] == ['Replica Lag']
+        assert cached.headers.get('ETag')
+        assert client.get('/api/context?lat=-33.0&lng=151.0&radius=500',
+                          headers={'If-None-Match': cached.headers['ETag']}).status_code == 304
+
+        # Larger than every cache bucket, so answered by the replica: no ETag to pin it
+        uncached = client.get('/api/context?lat=-33.0&lng=151.0&radius=10000')
+        assert uncached.status_code == 200
+        assert 'Replica Lag' not in [loc['name'] for loc in uncached.get_json()]
+        assert uncached.headers.get('ETag') is None
+
+        # No recent write of this user's own, so favorites are read from the replica too
+        favorites = client.get('/api/favorites', headers=headers)
+        assert favorites.status_code == 200
+        assert favorites.get_json() == []
+        assert favorites.headers.get('ETag') is None
+    finally:
+        app.config['REPLICA_BINDS'] = replica_binds
+        del db.engines['replica_stale']
+        stale.rollback()
+        replica.close()
+
+
+def test_image_cache_reuses_stored_url_and_counts_hits(app, fake_redis):
+    import image_cache
+    from models import GeneratedImage
+    image_cache.purge()
+    key = image_cache.prompt_key('test/model', 'a lighthouse at dusk')
+    image_cache.remember(key, 'test/model', 'a lighthouse at dusk', 'https://img/first.png')
+    image_cache.remember(key, 'test/model', 'a lighthouse at dusk', 'https://img/second.png')
+    db.session.commit()
+
+    assert image_cache.lookup(image_cache.prompt_key('test/model', 'something else')) is None
+    assert image_cache.lookup(key) == 'https://img/first.png'
+    assert image_cache.lookup(key) == 'https://img/first.png'
+    db.session.commit()
+    assert db.session.get(GeneratedImage, key).hits == 2
+
+    assert image_cache.stats() == {'entries': 1, 'reused': 2, 'hits': 2, 'misses': 1, 'hit_rate': 2 / 3}
+    assert image_cache.purge() == 1
+    assert image_cache.stats() == {'entries': 0, 'reused': 0, 'hits': 0, 'misses': 0, 'hit_rate': None}
+
+
+def test_image_cache_admin_survives_redis_outage(app, broken_redis):
+    import image_cache
+    assert 'hits' not in image_cache.stats()
+    assert image_cache.purge() >= 0
+
+
+def test_ping_record_falls_back_when_redis_is_down(app, broken_redis):
+    import pings
+    assert pings.record(1, 48.0, 2.0) is None
+
+
+def test_drain_pings_dispatches_locations_without_images(app, fake_redis, monkeypatch):
+    import pings
+    with app.app_context():
+        pending = Location(name='Ping Pending', latitude=-10.0, longitude=-50.0,
+                           coordinates=from_shape(Point(-50.0, -10.0), srid=4326))
+        ready = Location(name='Ping Ready', latitude=-10.001, longitude=-50.0, image_status='ready',
+                         coordinates=from_shape(Point(-50.0, -10.001), srid=4326))
+        db.session.add_all([pending, ready])
+        db.session.commit()
+        for lat in (-10.0, -10.0005, -10.0):
+            fake_redis.xadd(pings.STREAM_KEY, {'user_id': 1, 'lat': lat, 'lng': -50.0})
+
+        monkeypatch.setitem(app.config, 'PING_DRAIN_BATCH_SIZE', 2)
+        dispatched = []
+        assert pings.drain(dispatched.append) == 3
+        assert sorted(set(dispatched)) == [pending.id]
+        assert fake_redis.data[pings.STREAM_KEY] == []
+        assert pings.drain(dispatched.append) == 0
+
+
+def test_local_rate_limit_bucket_exhausts_and_refills(app, monkeypatch):
+    import rate_limit
+    clock = [1000.0]
+    slept = []
+
+    def sleep(seconds):
+        slept.append(seconds)
+        clock[0] += seconds
+    monkeypatch.setattr(rate_limit.time, 'monotonic', lambda: clock[0])
+    monkeypatch.setattr(rate_limit.time, 'sleep', sleep)
+    monkeypatch.setitem(app.config, 'RATE_LIMITS', {'test': (2.0, 3)})
+    monkeypatch.setattr(rate_limit, '_local_buckets', {})
+
+    assert [rate_limit._take_local('test', 2.0, 3) for _ in range(3)] == [0, 0, 0]
+    assert rate_limit._take_local('test', 2.0, 3) == pytest.approx(0.5)
+
+    # Without Redis, acquire() waits on the local bucket until a token has refilled
+    rate_limit.acquire('test')
+    assert slept == [pytest.approx(0.5)]
+
+    clock[0] += 10
+    assert [rate_limit._take_local('test', 2.0, 3) for _ in range(3)] == [0, 0, 0]
+
+
+def test_image_lease_deduplicates_dispatch_until_released(app, fake_redis):
+    from image_leases import acquire_image_lease, release_image_lease
+    assert acquire_image_lease(515151)
+    assert not acquire_image_lease(515151)
+    release_image_lease(515151)
+    assert acquire_image_lease(515151)
+
+
+def test_image_lease_fails_open_without_redis(app, broken_redis):
+    from image_leases import acquire_image_lease
+    assert acquire_image_lease(515152)
+    assert acquire_image_lease(515152)
+
+
+def test_upload_stream_sends_full_chunks_with_content_ranges(app, monkeypatch):
+    import io
+    import cloudinary.uploader
+    from cloudinary_utils import upload_stream
+
+    class Trickle(io.RawIOBase):
+        """An HTTP body that hands out at most 300 bytes per read, like a socket."""
+
+        def __init__(self, data):
+            self.data = io.BytesIO(data)
+
+        def read(self, n=-1):
+            return self.data.read(300 if n is None or n < 0 else min(n, 300))
+
+    parts = []
+
+    def upload_large_part(file, http_headers=None, **options):
+        name, chunk = file
+        parts.append((len(chunk), http_headers['Content-Range']))
+        return {'public_id': options.get('public_id'), 'secure_url': 'https://res.example/img.png'}
+    monkeypatch.setattr(cloudinary.uploader, 'upload_large_part', upload_large_part)
+    monkeypatch.setitem(app.config, 'CLOUDINARY_UPLOAD_CHUNK_SIZE', 1000)
+
+    assert upload_stream(Trickle(b'x' * 2500), 2500, public_id='explora/test') == 'https://res.example/img.png'
+    assert parts == [(1000, 'bytes 0-999/2500'), (1000, 'bytes 1000-1999/2500'), (500, 'bytes 2000-2499/2500')]
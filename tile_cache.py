@@ -0,0 +1,85 @@
+import math
+from flask import current_app
+import redis
+from extensions import get_redis
+
+# Rendered vector tiles keyed by z/x/y. A location write drops, at every zoom, the tile
+# holding the point plus any neighbour whose buffer (TILE_BUFFER of TILE_EXTENT units)
+# reaches it, since ST_AsMVTGeom keeps features inside the buffer on both tiles. Each entry
+# is prefixed with the 'locations' version it was rendered at, which its ETag is built from.
+
+KEY_PREFIX = 'tile:'
+
+
+def _key(z, x, y):
+    return f'{KEY_PREFIX}{z}:{x}:{y}'
+
+
+def get(z, x, y):
+    """(version, tile bytes) for a cached tile, or None."""
+    client = get_redis()
+    if client is None:
+        return None
+    try:
+        cached = client.get(_key(z, x, y))
+    except redis.RedisError as e:
+        current_app.logger.warning(f"Tile cache read failed: {e}")
+        return None
+    if cached is None:
+        return None
+    version, tile = cached.split(b'\n', 1)
+    return version.decode(), tile
+
+
+def put(z, x, y, version, tile):
+    client = get_redis()
+    if client is None or version is None:
+        return
+    try:
+        client.set(_key(z, x, y), version.encode() + b'\n' + tile, ex=current_app.config['TILE_CACHE_TTL'])
+    except redis.RedisError as e:
+        current_app.logger.warning(f"Tile cache write failed: {e}")
+
+
+def tiles_for(lat, lng, z):
+    """Every tile at zoom z that draws a point at (lat, lng), buffer included."""
+    n = 1 << z
+    lat = max(min(lat, 85.0511), -85.0511)
+    tx = (lng + 180.0) / 360.0 * n
+    ty = (1.0 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2.0 * n
+    margin = current_app.config['TILE_BUFFER'] / current_app.config['TILE_EXTENT']
+    xs = range(max(math.floor(tx - margin), 0), min(math.floor(tx + margin), n - 1) + 1)
+    ys = range(max(math.floor(ty - margin), 0), min(math.floor(ty + margin), n - 1) + 1)
+    return [(x, y) for x in xs for y in ys]
+
+
+def invalidate_location(lat, lng):
+    client = get_redis()
+    if client is None:
+        return
+    keys = [
+        _key(z, x, y)
+        for z in range(current_app.config['TILE_MAX_ZOOM'] + 1)
+        for x, y in tiles_for(lat, lng, z)
+    ]
+    try:
+        client.unlink(*keys)
+    except redis.RedisError as e:
+        current_app.logger.warning(f"Tile cache invalidation failed: {e}")
+
+
+def invalidate_all():
+    client = get_redis()
+    if client is None:
+        return
+    try:
+        batch = []
+        for key in client.scan_iter(match=f'{KEY_PREFIX}*', count=1000):
+            batch.append(key)
+            if len(batch) >= 500:
+                client.unlink(*batch)
+                batch = []
+        if batch:
+            client.unlink(*batch)
+    except redis.RedisError as e:
+        current_app.logger.warning(f"Tile cache invalidation failed: {e}")
@@ -0,0 +1,38 @@
+import uuid
+from flask import current_app
+import redis
+from extensions import get_redis
+
+# Monotonic change counters in Redis, bumped by writers and read by anything that needs
+# to notice a change cheaply. current() returns an opaque "<epoch>-<count>" token, or None
+# when Redis is unavailable, and callers must then treat the data as possibly changed. The
+# epoch is created alongside the counters, so after a Redis flush or restart the counters
+# starting again from 0 can never reproduce a token handed out before.
+
+KEY = 'version:{}'
+EPOCH_KEY = 'version:epoch'
+
+
+def bump(name):
+    client = get_redis()
+    if client is None:
+        return
+    try:
+        client.incr(KEY.format(name))
+    except redis.RedisError as e:
+        current_app.logger.warning(f"Version bump for {name} failed: {e}")
+
+
+def current(name):
+    client = get_redis()
+    if client is None:
+        return None
+    try:
+        epoch, count = client.mget(EPOCH_KEY, KEY.format(name))
+        if epoch is None:
+            client.set(EPOCH_KEY, uuid.uuid4().hex[:8], nx=True)
+            epoch = client.get(EPOCH_KEY)
+        return f"{epoch.decode()}-{int(count or 0)}"
+    except redis.RedisError as e:
+        current_app.logger.warning(f"Version read for {name} failed: {e}")
+        return None